@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Throughput and memory benchmarks of setop operations.
+
+    benchmark.py generate directory [options]    <--- write synthetic inputs
+    benchmark.py run [--data directory] -o results.json [options]
+    benchmark.py compare baseline.json results.json [--threshold ratio]
+
+Every mode is run as a separate setop process; its wall time and peak
+resident set size are recorded. Comparing two result files reports the
+relative change per mode and fails if any mode became slower (or larger)
+than the threshold allows.
+"""
+
+import sys
+import os
+import json
+import time
+import random
+import hashlib
+import argparse
+import platform
+import tempfile
+import shutil
+import subprocess
+
+SETOP = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "setop.py")
+
+# Set and multiset modes timed by default, by name.
+MODES = {"union": ["-u"],
+         "intersection": ["-i"],
+         "difference": ["-d"],
+         "product": ["-p"],
+         "multiset-union": ["-m", "-u"],
+         "multiset-intersection": ["-m", "-i"],
+         "multiset-difference": ["-m", "-d"],
+         "multiset-sum": ["-m", "-s"],
+         "multiset-product": ["-m", "-p"]}
+
+# Product output grows with the product of the input sizes, so it is
+# benchmarked on prefixes of the inputs of this many lines.
+PRODUCT_LINES = 1000
+
+
+def line_text(key, length):
+    """Deterministic line of given length for a key."""
+    digest = hashlib.blake2b(key.to_bytes(8, "little")).hexdigest()
+    return (digest * (length // len(digest) + 1))[:length]
+
+
+def generate_lines(rng, file_number, cardinality, duplicates, overlap, length):
+    """Lines of one synthetic file, in random order.
+
+    The file has `cardinality` distinct lines, of which the fraction `overlap`
+    is shared by all generated files. The fraction `duplicates` of all lines
+    are repetitions of lines already in the file.
+    """
+    shared = int(cardinality * overlap)
+    keys = list(range(shared))
+    keys += range((file_number + 1) << 40, ((file_number + 1) << 40) + cardinality - shared)
+    repeated = int(cardinality * duplicates / (1 - duplicates)) if duplicates < 1 else 0
+    keys += rng.choices(keys, k=repeated) if keys else []
+    rng.shuffle(keys)
+    return [line_text(key, length) for key in keys]
+
+
+def generate(directory, files, cardinality, duplicates, overlap, length, seed):
+    """Write synthetic input files to a directory, along with smaller ones
+    for products. Returns the parameters they were generated with."""
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    for file_number in range(files):
+        path = os.path.join(directory, "input%d.txt" % file_number)
+        lines = generate_lines(rng, file_number, cardinality, duplicates, overlap, length)
+        with open(path, "w") as fp:
+            fp.write("\n".join(lines))
+            fp.write("\n")
+        with open(os.path.join(directory, "product%d.txt" % file_number), "w") as fp:
+            fp.write("\n".join(lines[:PRODUCT_LINES]))
+            fp.write("\n")
+    parameters = dict(files=files, cardinality=cardinality, duplicates=duplicates,
+                      overlap=overlap, line_length=length, seed=seed)
+    with open(os.path.join(directory, "parameters.json"), "w") as fp:
+        json.dump(parameters, fp, indent=2)
+    return parameters
+
+
+def count_lines(path):
+    with open(path, "rb") as fp:
+        return sum(chunk.count(b"\n") for chunk in iter(lambda: fp.read(1 << 20), b""))
+
+
+def run_setop(command):
+    """Run a setop command, counting its output through a pipe. Returns wall
+    time in seconds, peak RSS in KiB and the number of output lines and bytes.
+
+    No output options are added, so any setop version can be benchmarked.
+    """
+    start = time.perf_counter()
+    with tempfile.TemporaryFile() as errors:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=errors)
+        lines = size = 0
+        for chunk in iter(lambda: process.stdout.read(1 << 20), b""):
+            lines += chunk.count(b"\n")
+            size += len(chunk)
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - start
+        process.stdout.close()
+        if os.waitstatus_to_exitcode(status) != 0:
+            errors.seek(0)
+            raise RuntimeError("%s failed: %s" % (" ".join(command),
+                                                  errors.read().decode(errors="replace")))
+    # ru_maxrss is in KiB on Linux, but in bytes on macOS.
+    peak_rss = usage.ru_maxrss // 1024 if sys.platform == "darwin" else usage.ru_maxrss
+    return seconds, peak_rss, lines, size
+
+
+def benchmark(setop, directory, modes, repeat, extra_options):
+    """Time modes on the inputs in a directory. Returns results by mode name."""
+    parameters_path = os.path.join(directory, "parameters.json")
+    with open(parameters_path) as fp:
+        files = json.load(fp)["files"]
+    results = {}
+    for name in modes:
+        prefix = "product" if MODES[name][-1] == "-p" else "input"
+        paths = [os.path.join(directory, "%s%d.txt" % (prefix, number)) for number in range(files)]
+        if prefix == "product":
+            paths = paths[:2]
+        input_lines = sum(map(count_lines, paths))
+        runs = [run_setop(setop + MODES[name] + extra_options + paths) for _ in range(repeat)]
+        seconds = min(run[0] for run in runs)
+        results[name] = dict(seconds=round(seconds, 6),
+                             input_lines=input_lines,
+                             output_lines=runs[0][2],
+                             output_bytes=runs[0][3],
+                             lines_per_second=round(input_lines / seconds),
+                             peak_rss_kib=max(run[1] for run in runs))
+        print("%-22s %8.3f s %12d lines/s %8d KiB" % (name, seconds, results[name]["lines_per_second"],
+                                                      results[name]["peak_rss_kib"]),
+              file=sys.stderr)
+    return results
+
+
+def compare(baseline, current, threshold):
+    """Print relative changes between two result files. Returns the names of
+    modes whose time or peak RSS regressed by more than the threshold.
+
+    Peak RSS is compared above that of an empty interpreter run, where the
+    result files record it."""
+    regressions = []
+    old_floor = baseline.get("interpreter_rss_kib", 0)
+    new_floor = current.get("interpreter_rss_kib", 0)
+    print("%-22s %10s %10s %8s %10s %10s %8s" % ("mode", "old s", "new s", "time",
+                                                 "old KiB", "new KiB", "rss"))
+    for name, old in baseline["results"].items():
+        new = current["results"].get(name)
+        if new is None:
+            continue
+        time_ratio = new["seconds"] / old["seconds"]
+        rss_ratio = (max(1, new["peak_rss_kib"] - new_floor)
+                     / max(1, old["peak_rss_kib"] - old_floor))
+        regressed = time_ratio > 1 + threshold or rss_ratio > 1 + threshold
+        print("%-22s %10.3f %10.3f %+7.1f%% %10d %10d %+7.1f%%%s"
+              % (name, old["seconds"], new["seconds"], 100 * (time_ratio - 1),
+                 old["peak_rss_kib"], new["peak_rss_kib"], 100 * (rss_ratio - 1),
+                 "  <--- regression" if regressed else ""))
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def add_generator_arguments(parser):
+    parser.add_argument("--files", type=int, default=3,
+                        help="number of input files (default: 3)")
+    parser.add_argument("--cardinality", type=int, default=200000,
+                        help="distinct lines per file (default: 200000)")
+    parser.add_argument("--duplicates", type=float, default=0.3,
+                        help="fraction of lines repeating earlier ones (default: 0.3)")
+    parser.add_argument("--overlap", type=float, default=0.5,
+                        help="fraction of distinct lines shared by all files (default: 0.5)")
+    parser.add_argument("--line-length", type=int, default=32,
+                        help="length of lines in characters (default: 32)")
+    parser.add_argument("--seed", type=int, default=42,
+                        help="random seed (default: 42)")
+
+
+def generator_parameters(arguments):
+    return (arguments.files, arguments.cardinality, arguments.duplicates,
+            arguments.overlap, arguments.line_length, arguments.seed)
+
+
+def generator_options(arguments):
+    """Command line options of the generate command for parsed arguments."""
+    return ["--files", str(arguments.files), "--cardinality", str(arguments.cardinality),
+            "--duplicates", str(arguments.duplicates), "--overlap", str(arguments.overlap),
+            "--line-length", str(arguments.line_length), "--seed", str(arguments.seed)]
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate_parser = commands.add_parser("generate", help="write synthetic input files")
+    generate_parser.add_argument("directory")
+    add_generator_arguments(generate_parser)
+
+    run_parser = commands.add_parser("run", help="time setop modes")
+    run_parser.add_argument("--data", metavar="directory", default=None,
+                            help="generated inputs to use (default: generate temporary ones)")
+    add_generator_arguments(run_parser)
+    run_parser.add_argument("--setop", default=None,
+                            help="setop command to benchmark (default: setop.py of this tree)")
+    run_parser.add_argument("--modes", nargs="+", choices=list(MODES), default=list(MODES),
+                            help="modes to time (default: all)")
+    run_parser.add_argument("--options", default="",
+                            help="extra setop options, e.g. \"--memory-limit 64M\"")
+    run_parser.add_argument("--repeat", type=int, default=3,
+                            help="runs per mode; the fastest is recorded (default: 3)")
+    run_parser.add_argument("-o", "--output", default=None,
+                            help="write JSON results to a file (default: stdout)")
+
+    compare_parser = commands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("results")
+    compare_parser.add_argument("--threshold", type=float, default=0.1,
+                                help="tolerated relative slowdown or growth (default: 0.1)")
+
+    arguments = parser.parse_args(args)
+
+    if arguments.command == "generate":
+        generate(arguments.directory, *generator_parameters(arguments))
+        return 0
+
+    if arguments.command == "compare":
+        with open(arguments.baseline) as fp:
+            baseline = json.load(fp)
+        with open(arguments.results) as fp:
+            current = json.load(fp)
+        return 1 if compare(baseline, current, arguments.threshold) else 0
+
+    setop = arguments.setop.split() if arguments.setop else [sys.executable, SETOP]
+    directory = arguments.data or tempfile.mkdtemp(prefix="setop-benchmark-")
+    try:
+        if arguments.data is None:
+            # The peak RSS of a child process starts at that of this process,
+            # so the inputs are generated in a separate process.
+            subprocess.run([sys.executable, os.path.abspath(__file__), "generate", directory]
+                           + generator_options(arguments), check=True)
+        with open(os.path.join(directory, "parameters.json")) as fp:
+            parameters = json.load(fp)
+        results = benchmark(setop, directory, arguments.modes, arguments.repeat,
+                            arguments.options.split())
+    finally:
+        if arguments.data is None:
+            shutil.rmtree(directory)
+    # Peak RSS of any command run here, and so the least one can report.
+    _, interpreter_rss, _, _ = run_setop([sys.executable, "-c", "pass"])
+
+    report = dict(setop=" ".join(setop), options=arguments.options,
+                  python=platform.python_version(), platform=platform.platform(),
+                  timestamp=time.strftime("%Y-%m-%dT%H:%M:%S"),
+                  data=parameters, interpreter_rss_kib=interpreter_rss, results=results)
+    if arguments.output:
+        with open(arguments.output, "w") as fp:
+            json.dump(report, fp, indent=2)
+            fp.write("\n")
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Per-invocation latency of setop on tiny inputs.
+
+    startup.py [--baseline directory] [--runs N] [-o results.json]
+
+Runs scripts/setop many times on two small files and reports the median wall
+time of: the bare interpreter, the fast command line path, the same command
+through the full argparse parser, and, with --baseline, the setop module found
+in another directory (e.g. a checkout of an earlier version).
+"""
+
+import sys
+import os
+import json
+import time
+import argparse
+import tempfile
+import compileall
+import subprocess
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+SCRIPT = os.path.join(ROOT, "scripts", "setop")
+
+
+def median_latency(command, module_dir, runs):
+    """Median wall time in seconds of running a command with setop imported
+    from module_dir."""
+    environment = dict(os.environ, PYTHONPATH=module_dir)
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, env=environment, check=True)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times[len(times) // 2]
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--baseline", metavar="directory", default=None,
+                        help="directory with a setop.py to compare against")
+    parser.add_argument("--runs", type=int, default=50,
+                        help="invocations per command (default: 50)")
+    parser.add_argument("-o", "--output", default=None,
+                        help="also write JSON results to a file")
+    arguments = parser.parse_args(args)
+
+    with tempfile.TemporaryDirectory(prefix="setop-startup-") as directory:
+        paths = []
+        for name, lines in (("a", "foo\nbar\nbaz\n"), ("b", "bar\nquux\n")):
+            paths.append(os.path.join(directory, name))
+            with open(paths[-1], "w") as fp:
+                fp.write(lines)
+
+        # Imported modules are normally byte-compiled; make sure no run pays
+        # for compiling setop.py.
+        module_dirs = [ROOT] + ([os.path.abspath(arguments.baseline)] if arguments.baseline else [])
+        for module_dir in module_dirs:
+            compileall.compile_file(os.path.join(module_dir, "setop.py"), quiet=1)
+
+        python = [sys.executable]
+        cases = [("interpreter", python + ["-c", "pass"], ROOT),
+                 ("fast path", python + [SCRIPT, "-u"] + paths, ROOT),
+                 ("argparse path", python + [SCRIPT, "-u", "--order", "sorted"] + paths, ROOT)]
+        if arguments.baseline:
+            cases.append(("baseline", python + [SCRIPT, "-u"] + paths,
+                          os.path.abspath(arguments.baseline)))
+
+        results = {}
+        for name, command, module_dir in cases:
+            results[name] = median_latency(command, module_dir, arguments.runs)
+            print("%-14s %8.1f ms" % (name, 1000 * results[name]))
+
+    if arguments.output:
+        with open(arguments.output, "w") as fp:
+            json.dump({name: round(seconds, 6) for name, seconds in results.items()}, fp, indent=2)
+            fp.write("\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -36,17 +36,27 @@ URL:    https://github.com/tigr42/setop
 """
 
 import sys
-import argparse
-import functools
+import os
+import io
+import stat
+import time
 import itertools
-import collections
 import operator
 
+# Other modules are imported where they are needed, since setop is often run
+# many times on small inputs, where startup time dominates.
+
 __VERSION__ = (0, 2)
 
 
+class UnsortedInputError(Exception):
+    """Raised when an input declared as sorted is out of order."""
+
+
 class MultiSet:
+    """Multiset of lines, stored as a count for each distinct line."""
     def __init__(self, it=None):
+        import collections
         self.data = collections.Counter(it)
         
     def discard(self, what):
@@ -55,66 +65,2027 @@ class MultiSet:
     def __iter__(self):
         return self.data.elements()
     
-    def __and__(self, other):
+    def __len__(self):
+        return sum(self.data.values())
+    
+    def _combine(self, other, function):
         if isinstance(other, MultiSet):
-            result = MultiSet(self.data.elements())
-            result.data &= other.data
+            result = MultiSet()
+            result.data = function(self.data, other.data)
             return result
         else:
             return NotImplemented
     
-    def __or__(self, other):
+    def _update(self, other, function):
         if isinstance(other, MultiSet):
-            result = MultiSet(self.data.elements())
-            result.data |= other.data
-            return result
+            self.data = function(self.data, other.data)
+            return self
         else:
             return NotImplemented
     
+    def __and__(self, other):
+        return self._combine(other, operator.and_)
+    
+    def __or__(self, other):
+        return self._combine(other, operator.or_)
+    
     def __add__(self, other):
-        if isinstance(other, MultiSet):
-            result = MultiSet(self.data.elements())
-            result.data += other.data
+        return self._combine(other, operator.add)
+    
+    def __sub__(self, other):
+        return self._combine(other, operator.sub)
+    
+    def __iand__(self, other):
+        return self._update(other, operator.iand)
+    
+    def __ior__(self, other):
+        return self._update(other, operator.ior)
+    
+    def __iadd__(self, other):
+        return self._update(other, operator.iadd)
+    
+    def __isub__(self, other):
+        return self._update(other, operator.isub)
+ 
+
+def binary_file(file):
+    """Return the binary buffer behind a text file object (e.g. sys.stdin)."""
+    return getattr(file, "buffer", file)
+
+
+# Size of the blocks in which input files are read and split into lines.
+INPUT_CHUNK_SIZE = 1 << 20
+
+# Smallest byte range of an input scattered by one task of --jobs.
+PARALLEL_RANGE_SIZE = 1 << 20
+
+
+def read_chunks(file, chunk_size=INPUT_CHUNK_SIZE):
+    """Yield blocks of a file which end at line boundaries.
+
+    Regular files are read into one reused buffer, so that memory use does
+    not grow with the file; pipes and stdin are read in blocks of whatever
+    data is available, so streaming consumers get lines early.
+    """
+    if isinstance(file, MeasuredInput):
+        yield from file.measure(read_chunks(file.file, chunk_size))
+        return
+    if isinstance(file, IterableInput):
+        yield from file.read_chunks()
+        return
+    file = binary_file(file)
+    try:
+        regular = stat.S_ISREG(os.fstat(file.fileno()).st_mode)
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        regular = False
+
+    if regular:
+        buffer, filled = bytearray(chunk_size), 0
+        while True:
+            with memoryview(buffer) as view:
+                count = file.readinto(view[filled:])
+            if not count:
+                break
+            filled += count
+            end = buffer.rfind(b"\n", 0, filled) + 1
+            if end:
+                with memoryview(buffer) as view:
+                    yield bytes(view[:end])
+                buffer[:filled - end] = buffer[end:filled]
+                filled -= end
+            elif filled == len(buffer):
+                # The buffer holds part of a single line; make room for more.
+                buffer.extend(bytes(len(buffer)))
+        if filled:
+            yield bytes(buffer[:filled])
+        return
+
+    read = getattr(file, "read1", file.read)
+    rest = b""
+    while True:
+        block = read(chunk_size)
+        if not block:
+            break
+        end = block.rfind(b"\n") + 1
+        if end:
+            yield rest + block[:end]
+            rest = block[end:]
+        else:
+            rest += block
+    if rest:
+        yield rest
+
+
+# Leading bytes of supported compressed file formats. A bzip2 stream starts
+# with "BZh", the block size digit and the magic of its first block, or of
+# the end of stream if it is empty; "BZh" alone is common in plain text.
+COMPRESSION_MAGIC = [(b"\x1f\x8b", "gzip"),
+                     *((b"BZh%d%s" % (level, block), "bz2")
+                       for level in range(1, 10) for block in (b"1AY&SY", b"\x17rE8P\x90")),
+                     (b"\xfd7zXZ\x00", "xz"),
+                     (b"\x28\xb5\x2f\xfd", "zstd")]
+
+# Number of decompressed blocks each prefetching thread may read ahead.
+PREFETCH_DEPTH = 8
+
+
+def zstd_module():
+    """Return the optional zstandard module, or raise OSError without it."""
+    try:
+        import zstandard
+    except ImportError:
+        raise OSError("Zstandard compression requires the zstandard module")
+    return zstandard
+
+
+def numpy_available():
+    """Whether the optional numpy module is installed."""
+    import importlib.util
+    return importlib.util.find_spec("numpy") is not None
+
+
+def compression_format(file):
+    """Detect the compression format of a buffered binary file from its first
+    bytes, without consuming them. Returns None for uncompressed files."""
+    peek = getattr(file, "peek", None)
+    if peek is None:
+        return None
+    head = peek(10)
+    for magic, compression in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+class PrefetchedInput:
+    """Binary input decompressed ahead of its reader by a background thread.
+
+    Decompressors release the GIL, so several compressed inputs are decoded
+    concurrently while the main thread builds line sets.
+    """
+    def __init__(self, file, compression):
+        import threading
+        import queue
+        import gzip
+        import bz2
+        import lzma
+        self.name = file.name
+        self.source = file
+        if compression == "gzip":
+            stream = gzip.GzipFile(fileobj=file, mode="rb")
+        elif compression == "bz2":
+            stream = bz2.BZ2File(file)
+        elif compression == "xz":
+            stream = lzma.LZMAFile(file)
+        else:
+            stream = zstd_module().ZstdDecompressor().stream_reader(file, read_across_frames=True)
+        self.blocks = queue.Queue(PREFETCH_DEPTH)
+        self.finished = False
+        threading.Thread(target=self._prefetch, args=(stream,), daemon=True).start()
+    
+    def _prefetch(self, stream):
+        try:
+            while True:
+                block = stream.read(INPUT_CHUNK_SIZE)
+                self.blocks.put(block)
+                if not block:
+                    break
+        except Exception as error:
+            self.blocks.put(error)
+    
+    def read1(self, size=-1):
+        """Return the next decompressed block (of any size), b"" at the end."""
+        if self.finished:
+            return b""
+        block = self.blocks.get()
+        if isinstance(block, Exception):
+            self.finished = True
+            raise OSError("%s: %s" % (self.name, block))
+        self.finished = not block
+        return block
+    
+    read = read1
+    
+    def seekable(self):
+        return False
+
+
+def open_input(file):
+    """Wrap a binary input file in a decompressing reader if it is compressed."""
+    file = binary_file(file)
+    compression = compression_format(file)
+    if compression is None:
+        return file
+    return PrefetchedInput(file, compression)
+
+
+class IterableInput:
+    """Input file reading lines from an iterable of bytes or str lines.
+
+    Trailing CR/LF characters are removed from the lines and str lines are
+    encoded, so lines are compared like lines read from files.
+    """
+    name = "<iterable>"
+    
+    def __init__(self, lines, encoding="utf-8"):
+        self.lines = iter(lines)
+        self.encoding = encoding
+    
+    def read_lines(self):
+        for line in self.lines:
+            if isinstance(line, str):
+                line = line.encode(self.encoding)
+            yield line.rstrip(b"\r\n")
+    
+    def read_chunks(self):
+        lines = self.read_lines()
+        while True:
+            batch = list(itertools.islice(lines, OUTPUT_BATCH_LINES))
+            if not batch:
+                break
+            batch.append(b"")
+            yield b"\n".join(batch)
+    
+    def seekable(self):
+        return False
+
+
+class MeasuredInput:
+    """Input file wrapper collecting reading statistics for --stats.
+
+    Counts lines and bytes of the chunks read, and the wall and CPU time spent
+    reading them; the number of distinct lines is recorded when the input is
+    loaded into a set. Inputs read more than once (e.g. with --hash-keys or
+    --verify) report the lines and bytes of their longest pass and the number
+    of passes, while times add up over all passes. Inputs which were not read
+    by this process (e.g. with --jobs or through an index) report no lines
+    and bytes.
+    """
+    def __init__(self, file):
+        self.file = file
+        self.name = file.name
+        self.lines = 0
+        self.bytes = 0
+        self.distinct = None
+        self.passes = 0
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+    
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+    
+    def measure(self, chunks):
+        self.passes += 1
+        lines = size = 0
+        while True:
+            wall_start, cpu_start = time.perf_counter(), time.process_time()
+            chunk = next(chunks, None)
+            self.wall_time += time.perf_counter() - wall_start
+            self.cpu_time += time.process_time() - cpu_start
+            if chunk is None:
+                break
+            lines += chunk.count(b"\n") + (not chunk.endswith(b"\n"))
+            size += len(chunk)
+            self.lines, self.bytes = max(self.lines, lines), max(self.bytes, size)
+            yield chunk
+    
+    def record_distinct(self, line_set):
+        self.distinct = len(line_set.data if isinstance(line_set, MultiSet) else line_set)
+    
+    def stats(self):
+        distinct = self.distinct
+        lines, size = (self.lines, self.bytes) if self.passes else (None, None)
+        return dict(name=self.name if isinstance(self.name, str) else repr(self.name),
+                    lines=lines, bytes=size, distinct=distinct,
+                    duplicates=lines - distinct if None not in (lines, distinct) else None,
+                    passes=self.passes,
+                    wall=round(self.wall_time, 6), cpu=round(self.cpu_time, 6))
+
+
+def source_file(file):
+    """The underlying file of an input, e.g. the compressed file behind it."""
+    return getattr(file, "source", binary_file(file))
+
+
+def split_lines(chunk):
+    """Split a block of text into lines without trailing CR/LF characters."""
+    lines = chunk.split(b"\n")
+    if chunk.endswith(b"\n"):
+        lines.pop()
+    if b"\r" in chunk:
+        lines = [line.rstrip(b"\r") for line in lines]
+    return lines
+
+
+def read_lines(file, chunk_size=INPUT_CHUNK_SIZE):
+    """Generate lines of a file (possibly empty ones) without line separators."""
+    if isinstance(file, IterableInput):
+        yield from file.read_lines()
+        return
+    for chunk in read_chunks(file, chunk_size):
+        yield from split_lines(chunk)
+
+
+class OrderedSet:
+    """Set of lines which keeps the order in which lines were first seen."""
+    def __init__(self, it=None):
+        self.data = dict.fromkeys(it if it is not None else ())
+    
+    def discard(self, what):
+        self.data.pop(what, None)
+    
+    def __iter__(self):
+        return iter(self.data)
+    
+    def __len__(self):
+        return len(self.data)
+    
+    def __and__(self, other):
+        if isinstance(other, OrderedSet):
+            return OrderedSet(filter(other.data.__contains__, self.data))
+        else:
+            return NotImplemented
+    
+    def __or__(self, other):
+        if isinstance(other, OrderedSet):
+            result = OrderedSet(self.data)
+            result.data.update(other.data)
             return result
         else:
             return NotImplemented
     
     def __sub__(self, other):
-        if isinstance(other, MultiSet):
-            result = MultiSet(self.data.elements())
-            result.data -= other.data
-            return result
+        if isinstance(other, OrderedSet):
+            return OrderedSet(itertools.filterfalse(other.data.__contains__, self.data))
         else:
             return NotImplemented
- 
+
 
 def line_set(set_impl, file):
     """Read lines from a file object into a set_impl object."""
-    if file.name == "<stdin>": file = file.buffer  # binary mode
-
-    strip_trailing_newline = lambda s: s.rstrip(b"\r\n")
-    line_set = set_impl(map(strip_trailing_newline, file.readlines()))
+    line_set = set_impl(read_lines(file))
     line_set.discard(b"")
+    if isinstance(file, MeasuredInput):
+        file.record_distinct(line_set)
     return line_set
 
 
-def reduce_line_sets(set_impl, files, function):
+def reduce_line_sets(set_impl, files, function, load=line_set):
     """Reduce sets of lines using given function."""
     if len(files) >= 1:
-        line_set_impl = functools.partial(line_set, set_impl)
-        x, *xs = map(line_set_impl, files)
-        tmp = functools.reduce(function, xs, x)
-        return tmp
+        in_place_function = IN_PLACE_OPERATIONS[function]
+        result = load(set_impl, files[0])
+        for file in files[1:]:
+            result = in_place_function(result, load(set_impl, file))
+        return result
     else:
         return set_impl()
 
 
+def key_pattern(field, separator):
+    """Compiled regular expression matching the field-th field (1-based) of every
+    non-empty line of a block of text; missing fields match as empty."""
+    import re
+    separator = re.escape(separator)
+    return re.compile(rb"^(?=[^\n]*[^\r\n])(?:(?:[^%s\n]*%s){%d}([^%s\r\n]*))?"
+                      % (separator, separator, field - 1, separator), re.MULTILINE)
+
+
+def read_keys(file, pattern):
+    """Generate the keys of the non-empty lines of a file, extracted per chunk."""
+    for chunk in read_chunks(file):
+        yield from pattern.findall(chunk)
+
+
+def read_keyed_lines(file, pattern):
+    """Generate (key, line) pairs of the non-empty lines of a file."""
+    for chunk in read_chunks(file):
+        yield from zip(pattern.findall(chunk), filter(None, split_lines(chunk)))
+
+
+def keyed_reduce_line_sets(set_impl, files, function, pattern):
+    """Reduce lines of files comparing only their keys, into a set_impl object.
+
+    Intersection and difference keep the lines of the first file whose key
+    occurs in all or none of the other files (a semi-join or anti-join).
+    Union keeps all lines of the first file and the lines of the following
+    files whose key does not occur in any preceding file.
+    """
+    if not files:
+        return set_impl()
+    first, *others = files
+    if function == operator.or_:
+        result, seen_keys = set_impl(), set()
+        for file in files:
+            new_lines, new_keys = [], set()
+            for key, line in read_keyed_lines(file, pattern):
+                if key not in seen_keys:
+                    new_lines.append(line)
+                    new_keys.add(key)
+            result |= set_impl(new_lines)
+            seen_keys |= new_keys
+        return result
+
+    keys = None
+    for file in others:
+        if keys is None:
+            keys = set(read_keys(file, pattern))
+        elif function == operator.and_:
+            keys.intersection_update(read_keys(file, pattern))
+        else:
+            keys.update(read_keys(file, pattern))
+    if keys is None:
+        return set_impl(line for _, line in read_keyed_lines(first, pattern))
+    wanted = function == operator.and_
+    return set_impl(line for key, line in read_keyed_lines(first, pattern)
+                    if (key in keys) == wanted)
+
+
+def file_size(file):
+    """Size of a regular file in bytes, or None for pipes and stdin."""
+    try:
+        stat_result = os.fstat(source_file(file).fileno())
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+    return stat_result.st_size if stat.S_ISREG(stat_result.st_mode) else None
+
+
+def intersect_lines(line_set, lines):
+    """Intersect a set, OrderedSet or MultiSet in place with streamed lines."""
+    import collections
+    if isinstance(line_set, MultiSet):
+        line_set.data &= collections.Counter(filter(line_set.data.__contains__, lines))
+    elif isinstance(line_set, OrderedSet):
+        found = set(filter(line_set.data.__contains__, lines))
+        line_set.data = dict.fromkeys(filter(found.__contains__, line_set.data))
+    else:
+        line_set.intersection_update(lines)
+
+
+def subtract_lines(line_set, lines):
+    """Remove streamed lines from a set, OrderedSet or MultiSet in place."""
+    if isinstance(line_set, MultiSet):
+        data = line_set.data
+        data.subtract(filter(data.__contains__, lines))
+        for line in [line for line, count in data.items() if count <= 0]:
+            del data[line]
+    elif isinstance(line_set, OrderedSet):
+        found = set(filter(line_set.data.__contains__, lines))
+        line_set.data = dict.fromkeys(itertools.filterfalse(found.__contains__, line_set.data))
+    else:
+        line_set.difference_update(lines)
+
+
+def probe_reduce_line_sets(set_impl, files, function, smallest_first=True):
+    """Intersection or difference of files, holding only one of them in memory.
+
+    Difference loads the first file, intersection the smallest regular file
+    (or the first one, unless smallest_first); the other files are streamed
+    and probed against the intermediate result, which never grows.
+    """
+    if not files:
+        return set_impl()
+    base = 0
+    if function == operator.and_ and smallest_first:
+        sizes = [file_size(file) for file in files]
+        base = min(range(len(files)),
+                   key=lambda i: (sizes[i] is None, sizes[i] or 0, i))
+
+    result = line_set(set_impl, files[base])
+    for file in files[:base] + files[base + 1:]:
+        if not result:
+            break
+        if function == operator.and_:
+            intersect_lines(result, read_lines(file))
+        else:
+            subtract_lines(result, read_lines(file))
+    return result
+
+
+# Operators of set expressions, by precedence level from loosest to tightest
+# binding, as in Python; the Unicode set symbols are accepted as well.
+EXPRESSION_OPERATORS = [{"|": operator.or_},
+                        {"&": operator.and_},
+                        {"+": operator.add, "-": operator.sub}]
+EXPRESSION_SYMBOLS = str.maketrans({"∪": "|", "∩": "&", "−": "-", "∖": "-"})
+
+
+def expression_operand(token, names):
+    """Index of the input file an operand ($N, or a file name with or without
+    its extension) refers to."""
+    if token.startswith("$"):
+        number = int(token[1:])
+        if not 1 <= number <= len(names):
+            raise ValueError("Invalid expression: there is no input file %s" % token)
+        return number - 1
+    names = [os.fsdecode(name) if isinstance(name, (str, bytes)) else "" for name in names]
+    matches = [index for index, name in enumerate(names)
+               if token in (os.path.basename(name), os.path.splitext(os.path.basename(name))[0])]
+    if not matches:
+        raise ValueError("Invalid expression: no input file is named %r; name files "
+                         "without their directory, or use $N" % token)
+    if len(matches) > 1:
+        raise ValueError("Invalid expression: %r names several input files; use $N" % token)
+    return matches[0]
+
+
+def expression_tokens(text, names):
+    """Split a set expression into operators and parentheses, and the input
+    file indexes of its operands. Raises ValueError.
+
+    Input file names are matched before the text is split at operators, so
+    that names like my-file.txt can be used as long as they are followed by
+    an operator, a parenthesis, a space or the end; the longest one wins.
+    Names can also be quoted.
+    """
+    import re
+    symbols = "()|&+-" + "".join(map(chr, EXPRESSION_SYMBOLS))
+    decoded = [os.path.basename(os.fsdecode(name)) if isinstance(name, (str, bytes)) else ""
+               for name in names]
+    candidates = sorted({variant for name in decoded
+                         for variant in (name, os.path.splitext(name)[0]) if variant},
+                        key=len, reverse=True)
+    word = re.compile(r"\$\d+|[^\s%s$'\"]+|\S" % re.escape(symbols))
+    tokens = []
+    position = 0
+    while position < len(text):
+        if text[position].isspace():
+            position += 1
+        elif text[position] in "'\"":
+            end = text.find(text[position], position + 1)
+            if end < 0:
+                raise ValueError("Invalid expression: missing %s" % text[position])
+            tokens.append(expression_operand(text[position + 1:end], names))
+            position = end + 1
+        elif text[position] in symbols:
+            tokens.append(text[position].translate(EXPRESSION_SYMBOLS))
+            position += 1
+        else:
+            for name in candidates:
+                end = position + len(name)
+                if text.startswith(name, position) and (end == len(text) or text[end].isspace()
+                                                        or text[end] in symbols):
+                    break
+            else:
+                end = word.match(text, position).end()
+            token = text[position:end]
+            tokens.append(token if token == "$" else expression_operand(token, names))
+            position = end
+    return tokens
+
+
+def parse_expression(text, names):
+    """Parse a set expression over input files into a tree of (function, left,
+    right) tuples with input file indexes as leaves. Raises ValueError."""
+    tokens = expression_tokens(text, names)
+    position = 0
+    
+    def parse_level(level):
+        nonlocal position
+        if level == len(EXPRESSION_OPERATORS):
+            return parse_atom()
+        node = parse_level(level + 1)
+        while position < len(tokens) and tokens[position] in EXPRESSION_OPERATORS[level]:
+            function = EXPRESSION_OPERATORS[level][tokens[position]]
+            position += 1
+            node = (function, node, parse_level(level + 1))
+        return node
+    
+    def parse_atom():
+        nonlocal position
+        if position == len(tokens):
+            raise ValueError("Invalid expression: unexpected end")
+        token = tokens[position]
+        position += 1
+        if isinstance(token, int):
+            return token
+        if token == "(":
+            node = parse_level(0)
+            if position == len(tokens) or tokens[position] != ")":
+                raise ValueError("Invalid expression: missing )")
+            position += 1
+            return node
+        raise ValueError("Invalid expression: unexpected %s" % describe(token))
+    
+    def describe(token):
+        return "$%d" % (token + 1) if isinstance(token, int) else repr(token)
+    
+    tree = parse_level(0)
+    if position < len(tokens):
+        raise ValueError("Invalid expression: unexpected %s" % describe(tokens[position]))
+    return tree
+
+
+def expression_leaves(tree):
+    """Input file indexes of the leaves of an expression tree."""
+    if isinstance(tree, int):
+        return [tree]
+    return expression_leaves(tree[1]) + expression_leaves(tree[2])
+
+
+def expression_functions(tree):
+    """Set of the functions applied in an expression tree."""
+    if isinstance(tree, int):
+        return set()
+    return {tree[0]} | expression_functions(tree[1]) | expression_functions(tree[2])
+
+
+def evaluate_expression(set_impl, files, tree, smallest_first=True):
+    """Evaluate an expression tree over input files, reading each file once.
+
+    Files referenced more than once are loaded once and shared. The right
+    operand of intersection or difference is streamed and probed against
+    the left one when it is a file referenced only once; intersection also
+    streams a left operand like that (unless smallest_first is false, which
+    keeps the order of lines of the left operand).
+    """
+    import collections
+    references = collections.Counter(expression_leaves(tree))
+    loaded = {}
+    
+    def load(index):
+        """Line set of a file, and whether the caller may modify it."""
+        if index not in loaded:
+            loaded[index] = line_set(set_impl, files[index])
+        return loaded[index], references[index] == 1
+    
+    def streamed(node):
+        return isinstance(node, int) and references[node] == 1
+    
+    def evaluate_node(node):
+        if isinstance(node, int):
+            return load(node)
+        function, left, right = node
+        if function == operator.and_ and smallest_first and streamed(left) \
+                and not streamed(right):
+            left, right = right, left
+        if function in (operator.and_, operator.sub) and streamed(right):
+            result, owned = evaluate_node(left)
+            if not owned:
+                result = result | set_impl()
+            if result:
+                lines = read_lines(files[right])
+                if function == operator.and_:
+                    intersect_lines(result, lines)
+                else:
+                    subtract_lines(result, lines)
+            return result, True
+        (left_set, owned), (right_set, _) = evaluate_node(left), evaluate_node(right)
+        if owned:
+            return IN_PLACE_OPERATIONS[function](left_set, right_set), True
+        return function(left_set, right_set), True
+    
+    return evaluate_node(tree)[0]
+
+
+# In-place variants of set operations, used to reduce freshly loaded line sets.
+IN_PLACE_OPERATIONS = {operator.or_: operator.ior,
+                       operator.and_: operator.iand,
+                       operator.add: operator.iadd,
+                       operator.sub: operator.isub}
+
+
+# How duplicate counts of one line combine across files for each set operation
+# in the merge-based (sorted stream) engine.  Set mode uses counts of 0 and 1.
+COUNT_FUNCTIONS = {operator.or_: max,
+                   operator.and_: min,
+                   operator.add: operator.add,
+                   operator.sub: operator.sub}
+
+# Maximum number of sorted runs merged at once by the external-memory engine.
+MERGE_FAN_IN = 64
+
+# Estimated per-line overhead (hash table entry, count, slot of the sorted
+# list, allocator rounding) of a run held in memory, on top of the size of
+# the bytes object itself.
+RUN_LINE_OVERHEAD = 128
+
+# Input is read in blocks of at most 1/RUN_CHUNK_FRACTION of the memory limit,
+# and the lines split from a block take up to RUN_CHUNK_OVERHEAD times its
+# size, which is reserved from the memory limit.
+RUN_CHUNK_FRACTION = 32
+RUN_CHUNK_OVERHEAD = 8
+
+
+# Default size of the output buffer of LineWriter, and number of lines joined
+# into the buffer at once.
+OUTPUT_BUFFER_SIZE = 1 << 20
+OUTPUT_BATCH_LINES = 4096
+
+
+def parse_size(text):
+    """Parse a size like 65536, 512K, 100M or 2G into a number of bytes."""
+    import argparse
+    units = dict(K=1 << 10, M=1 << 20, G=1 << 30, T=1 << 40)
+    number, unit = text, ""
+    if text[-1:].upper() in units:
+        number, unit = text[:-1], text[-1].upper()
+    try:
+        size = int(number) * units.get(unit, 1)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid size: %r" % text)
+    if size <= 0:
+        raise argparse.ArgumentTypeError("size must be positive: %r" % text)
+    return size
+
+
+def probability(text):
+    """Parse a probability strictly between 0 and 1 command line argument."""
+    import argparse
+    try:
+        number = float(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid probability: %r" % text)
+    if not 0 < number < 1:
+        raise argparse.ArgumentTypeError("probability must be between 0 and 1: %r" % text)
+    return number
+
+
+def positive_int(text):
+    """Parse a positive integer command line argument."""
+    import argparse
+    try:
+        number = int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid number: %r" % text)
+    if number <= 0:
+        raise argparse.ArgumentTypeError("number must be positive: %r" % text)
+    return number
+
+
+def write_run(counted_lines, temp_dir=None):
+    """Spill (line, count) pairs to an anonymous temporary file."""
+    import tempfile
+    run = tempfile.TemporaryFile(dir=temp_dir)
+    run.writelines(b"%d\t%s\n" % (count, line) for line, count in counted_lines)
+    run.seek(0)
+    return run
+
+
+def read_run(run):
+    """Read (line, count) pairs back from a run written by write_run()."""
+    for record in run:
+        count, line = record[:-1].split(b"\t", 1)
+        yield line, int(count)
+    run.close()
+
+
+def combine_counts(counted_lines):
+    """Sum counts of adjacent equal lines of a sorted (line, count) stream."""
+    for line, group in itertools.groupby(counted_lines, key=operator.itemgetter(0)):
+        yield line, sum(count for _, count in group)
+
+
+def sorted_runs(file, memory_limit, temp_dir=None):
+    """Split lines of a file into sorted runs of bounded size on disk."""
+    import collections
+    chunk_size = max(4096, min(INPUT_CHUNK_SIZE, memory_limit // RUN_CHUNK_FRACTION))
+    run_limit = max(memory_limit - RUN_CHUNK_OVERHEAD * chunk_size, memory_limit // 4)
+    run, size = collections.Counter(), 0
+    for line in read_lines(file, chunk_size):
+        if not line:
+            continue
+        if line not in run:
+            size += sys.getsizeof(line) + RUN_LINE_OVERHEAD
+        run[line] += 1
+        if size >= run_limit:
+            yield write_run(((line, run[line]) for line in sorted(run)), temp_dir)
+            run, size = collections.Counter(), 0
+    if run:
+        yield write_run(((line, run[line]) for line in sorted(run)), temp_dir)
+
+
+def merge_runs(runs):
+    """Sorted (line, count) stream of merged runs, closing them when done."""
+    import heapq
+    return combine_counts(heapq.merge(*map(read_run, runs)))
+
+
+def external_line_counts(file, memory_limit, temp_dir=None):
+    """Sorted (line, count) stream of a file, using at most memory_limit of RAM.
+
+    Runs are merged in cascades while they are produced: as soon as there are
+    MERGE_FAN_IN runs of one level, they are merged into one run of the next
+    level. Each level keeps fewer than MERGE_FAN_IN runs open, so the number of
+    open files grows only with the logarithm of the input size.
+    """
+    levels = [[]]
+    for run in sorted_runs(file, memory_limit, temp_dir):
+        levels[0].append(run)
+        for level, runs in enumerate(levels):
+            if len(runs) < MERGE_FAN_IN:
+                break
+            if level + 1 == len(levels):
+                levels.append([])
+            levels[level + 1].append(write_run(merge_runs(runs), temp_dir))
+            runs.clear()
+    return merge_runs([run for runs in levels for run in runs])
+
+
+def merge_line_counts(set_impl, counted_streams, function):
+    """Combine sorted (line, count) streams of several files using function.
+
+    Yields sorted (line, count) pairs of the result; counts are 1 in set mode.
+    """
+    import functools
+    import heapq
+    
+    def tagged(index, stream):
+        for line, count in stream:
+            yield line, index, count
+
+    multiset = set_impl == MultiSet
+    count_function = COUNT_FUNCTIONS[function]
+    merged = heapq.merge(*itertools.starmap(tagged, enumerate(counted_streams)))
+    for line, group in itertools.groupby(merged, key=operator.itemgetter(0)):
+        counts = [0] * len(counted_streams)
+        for _, index, count in group:
+            counts[index] = count if multiset else 1
+        count = functools.reduce(count_function, counts)
+        if count > 0:
+            yield line, count if multiset else 1
+
+
+def presorted_line_counts(file):
+    """Sorted (line, count) stream of a file which is already sorted.
+
+    Raises UnsortedInputError when a line sorts before its predecessor.
+    """
+    previous, count = b"", 0
+    for number, line in enumerate(read_lines(file), 1):
+        if not line:
+            continue
+        if line < previous:
+            raise UnsortedInputError("Input %s is not sorted (line %d); sort it with "
+                                     "LC_ALL=C sort first" % (file.name, number))
+        if line == previous:
+            count += 1
+            continue
+        if previous:
+            yield previous, count
+        previous, count = line, 1
+    if previous:
+        yield previous, count
+
+
+def expand_line_counts(counted_lines):
+    """Turn (line, count) pairs into lines, repeating each line count times."""
+    for line, count in counted_lines:
+        for _ in range(count):
+            yield line
+
+
+def external_reduce_line_sets(set_impl, files, function, memory_limit, temp_dir=None):
+    """Sorted (line, count) pairs of reduced line sets, spilling to disk to bound
+    memory use."""
+    counted_streams = [external_line_counts(file, memory_limit, temp_dir)
+                       for file in files]
+    return merge_line_counts(set_impl, counted_streams, function)
+
+
+def merge_sorted_files(set_impl, files, function):
+    """Sorted (line, count) pairs of sorted files combined using function, in a
+    single streaming pass."""
+    counted_streams = [presorted_line_counts(file) for file in files]
+    return merge_line_counts(set_impl, counted_streams, function)
+
+
+INDEX_MAGIC = b"setop-index-1"
+INDEX_SUFFIX = ".setop-index"
+
+
+def index_path(path, index_dir=None):
+    """Path of the index of an input file: a sidecar file, or one in index_dir."""
+    import hashlib
+    if index_dir is None:
+        return path + INDEX_SUFFIX
+    key = hashlib.sha1(os.fsencode(os.path.abspath(path))).hexdigest()
+    return os.path.join(index_dir, key + INDEX_SUFFIX)
+
+
+def indexable(file):
+    """Whether an input file can be indexed: a regular file whose name is a path
+    to the same file, which rules out stdin even when redirected from a file."""
+    if file_size(file) is None or not isinstance(file.name, (str, bytes)):
+        return False
+    try:
+        path_stat = os.stat(file.name)
+    except OSError:
+        return False
+    file_stat = os.fstat(source_file(file).fileno())
+    return (path_stat.st_dev, path_stat.st_ino) == (file_stat.st_dev, file_stat.st_ino)
+
+
+def index_key(file):
+    """Key identifying an input file (and the platform) by path, size and mtime."""
+    stat_result = os.fstat(source_file(file).fileno())
+    path = os.fsencode(os.path.abspath(file.name)).hex().encode("ascii")
+    return b"%s\t%s\t%d\t%d\t%s" % (INDEX_MAGIC, sys.byteorder.encode("ascii"),
+                                     stat_result.st_size, stat_result.st_mtime_ns, path)
+
+
+def build_index(file, index, path, key, memory_limit=None, temp_dir=None):
+    """Write the index of a file to an open temporary file, then move it to path:
+    the sorted, distinct lines of the file and their counts.
+
+    The index consists of a header line (the key, number of lines and size of
+    the line block), the lines separated by LF, and an array of counts. It is
+    made readable by everyone the umask allows, so that indexes of shared
+    files can be shared too.
+    """
+    import array
+    header = b"%s\t%020d\t%020d\n"
+    counts = array.array("Q")
+    with index:
+        try:
+            if memory_limit is not None:
+                counted_lines = external_line_counts(file, memory_limit, temp_dir)
+            else:
+                counted_lines = sorted_counts(line_set(MultiSet, file))
+            index.write(header % (key, 0, 0))
+            lines_size = 0
+            for line, count in counted_lines:
+                lines_size += index.write(line + b"\n")
+                counts.append(count)
+            counts.tofile(index)
+            index.seek(0)
+            index.write(header % (key, len(counts), lines_size))
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(index.name, 0o666 & ~umask)
+        except BaseException:
+            os.remove(index.name)
+            raise
+    os.replace(index.name, path)
+
+
+def load_index(file, index_dir=None, memory_limit=None, temp_dir=None):
+    """Sorted, distinct lines of a file and their counts, read from its index.
+
+    The index is built first if it does not exist or the file has changed.
+    Returns None when the index can be neither read nor written, e.g. the
+    index of a shared file in a directory that is not writable; the file is
+    then left to be read directly.
+    """
+    import array
+    import mmap
+    import tempfile
+    path = index_path(file.name, index_dir)
+    key = index_key(file)
+    try:
+        with open(path, "rb") as index:
+            header = index.readline()
+    except OSError:
+        header = b""
+    if header.rsplit(b"\t", 2)[0] != key:
+        try:
+            index = tempfile.NamedTemporaryFile(dir=os.path.dirname(path) or ".",
+                                                prefix=".setop-", delete=False)
+        except OSError:
+            return None
+        start = file.tell() if file.seekable() else None
+        try:
+            build_index(file, index, path, key, memory_limit, temp_dir)
+            with open(path, "rb") as index:
+                header = index.readline()
+        except OSError:
+            # The file has been read; fall back only if it can be read again.
+            if start is None:
+                raise
+            file.seek(start)
+            return None
+
+    _, line_count, lines_size = header.rsplit(b"\t", 2)
+    line_count, lines_size = int(line_count), int(lines_size)
+    with open(path, "rb") as index, \
+         mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        start = len(header)
+        lines = data[start:start + lines_size].split(b"\n")
+        lines.pop()
+        counts = array.array("Q", data[start + lines_size:start + lines_size + 8 * line_count])
+    return lines, counts
+
+
+def indexed_line_set(set_impl, file, index_dir=None, memory_limit=None, temp_dir=None):
+    """Read lines of a file into a set_impl object through the file's index.
+
+    Files which cannot be indexed, like stdin, or whose index can be neither
+    read nor written are read directly. Indexes of compressed files are keyed
+    on the compressed file.
+    """
+    index = load_index(file, index_dir, memory_limit, temp_dir) if indexable(file) else None
+    if index is None:
+        return line_set(set_impl, file)
+    lines, counts = index
+    if set_impl == MultiSet:
+        return MultiSet(dict(zip(lines, counts)))
+    return set_impl(lines)
+
+
+def indexed_line_counts(set_impl, file, index_dir=None, memory_limit=None, temp_dir=None):
+    """Sorted (line, count) pairs of a file read through the file's index."""
+    index = load_index(file, index_dir, memory_limit, temp_dir) if indexable(file) else None
+    if index is None:
+        return line_counts(set_impl, file)
+    lines, counts = index
+    return list(zip(lines, counts))
+
+
+def sorted_counts(line_set):
+    """Sorted (line, count) pairs of a set or MultiSet; counts are 1 for a set."""
+    if isinstance(line_set, MultiSet):
+        return sorted(line_set.data.items())
+    return [(line, 1) for line in sorted(line_set)]
+
+
+def sorted_lines(line_set):
+    """Sorted lines of a set or MultiSet, sorting only distinct lines."""
+    if isinstance(line_set, MultiSet):
+        return expand_line_counts(sorted_counts(line_set))
+    return sorted(line_set)
+
+
+def unsorted_counts(line_set):
+    """(line, count) pairs of a set, OrderedSet or MultiSet in its own order."""
+    if isinstance(line_set, MultiSet):
+        return list(line_set.data.items())
+    return [(line, 1) for line in line_set]
+
+
+def line_counts(set_impl, file):
+    """Sorted (line, count) pairs of a file; counts are 1 in set mode."""
+    return sorted_counts(line_set(set_impl, file))
+
+
+def read_range(path, start, end, chunk_size=INPUT_CHUNK_SIZE):
+    """Yield blocks of the lines of a file which start at byte offsets in
+    [start, end), so that ranges split at any offsets hold every line once."""
+    with open(path, "rb") as file:
+        if start:
+            file.seek(start - 1)
+            file.readline()
+        position = file.tell()
+        while position < end:
+            chunk = file.read(min(chunk_size, end - position))
+            if not chunk:
+                break
+            if not chunk.endswith(b"\n"):
+                chunk += file.readline()
+            position += len(chunk)
+            yield chunk
+
+
+def range_chunks(path, byte_range):
+    """Yield blocks of lines of a byte range of an input file (see read_range),
+    or of the whole input, decompressed, if byte_range is None."""
+    if byte_range is not None:
+        yield from read_range(path, *byte_range)
+        return
+    with open(path, "rb") as file:
+        yield from read_chunks(open_input(file))
+
+
+def scatter_range(spill_dir, jobs, task):
+    """Partition the lines of a byte range of input file number `number` by
+    their CRC-32, which is the same in every process, into up to jobs spill
+    files. Returns (partition, path) pairs of the spill files written."""
+    import collections
+    import zlib
+    number, path, byte_range = task
+    spills = {}
+    try:
+        for chunk in range_chunks(path, byte_range):
+            lines = split_lines(chunk)
+            buckets = [[] for _ in range(jobs)]
+            partitions = map(operator.mod, map(zlib.crc32, lines), itertools.repeat(jobs))
+            # Append every line to its bucket without a Python-level loop.
+            collections.deque(map(list.append, map(buckets.__getitem__, partitions), lines), 0)
+            for partition, bucket in enumerate(buckets):
+                if not bucket:
+                    continue
+                if partition not in spills:
+                    name = "%d-%d-%d" % (number, byte_range[0] if byte_range else 0, partition)
+                    spills[partition] = open(os.path.join(spill_dir, name), "wb")
+                bucket.append(b"")
+                spills[partition].write(b"\n".join(bucket))
+    finally:
+        for spill in spills.values():
+            spill.close()
+    return [(partition, spill.name) for partition, spill in spills.items()]
+
+
+def spill_chunks(paths):
+    """Generate blocks of lines of spill files."""
+    for path in paths:
+        with open(path, "rb") as spill:
+            yield from read_chunks(spill)
+
+
+def spill_lines(paths):
+    """Iterator over the lines of spill files, chained per block rather than
+    generated one by one."""
+    return itertools.chain.from_iterable(map(split_lines, spill_chunks(paths)))
+
+
+def reduce_partition(set_impl, function, ordered, spill_paths):
+    """Reduce one hash partition of the inputs, given the paths of its spill
+    files for each input; the other inputs of intersection and difference are
+    streamed and probed, as in probe_reduce_line_sets. Returns its lines, or
+    (line, count) pairs in multiset mode, sorted if ordered."""
+    in_place_function = IN_PLACE_OPERATIONS[function]
+    first, *others = spill_paths
+    result = set_impl(spill_lines(first))
+    result.discard(b"")
+    for paths in others:
+        if function == operator.and_:
+            intersect_lines(result, spill_lines(paths))
+        elif function == operator.sub:
+            subtract_lines(result, spill_lines(paths))
+        else:
+            line_set = set_impl(spill_lines(paths))
+            line_set.discard(b"")
+            result = in_place_function(result, line_set)
+    if set_impl == MultiSet:
+        return sorted_counts(result) if ordered else unsorted_counts(result)
+    return sorted(result) if ordered else list(result)
+
+
+def spool_input(file, temp_dir=None):
+    """Copy an input which cannot be reopened by its name (like stdin) to a
+    named temporary file. Returns the path of the copy."""
+    import tempfile
+    with tempfile.NamedTemporaryFile(dir=temp_dir, prefix=".setop-", delete=False) as spool:
+        for chunk in read_chunks(file):
+            spool.write(chunk)
+            if not chunk.endswith(b"\n"):
+                spool.write(b"\n")
+    return spool.name
+
+
+def scatter_tasks(files, jobs, spill_dir):
+    """Tasks of scatter_range for input files: (number, path, byte range) of up
+    to jobs ranges of each file, of at least PARALLEL_RANGE_SIZE bytes.
+
+    Compressed files are scattered as a whole; inputs which cannot be
+    reopened by their name are first copied to spill_dir."""
+    tasks = []
+    for number, file in enumerate(files):
+        if not indexable(file):
+            path = spool_input(file, spill_dir)
+        elif hasattr(file, "source"):
+            tasks.append((number, file.name, None))
+            continue
+        else:
+            path = file.name
+        size = os.path.getsize(path)
+        count = max(1, min(jobs, size // PARALLEL_RANGE_SIZE))
+        tasks += [(number, path, (size * i // count, size * (i + 1) // count))
+                  for i in range(count)]
+    return tasks
+
+
+def parallel_reduce_line_sets(set_impl, files, function, jobs, ordered=True, temp_dir=None):
+    """Lines, or (line, count) pairs in multiset mode, of reduced line sets,
+    reducing hash partitions in parallel.
+
+    Worker processes first scatter byte ranges of the inputs by the hash of
+    each line into one spill file per partition; equal lines always fall into
+    the same partition, so each worker then reduces one partition on its own.
+    Every line is read, hashed and spilled once, so all work but the final
+    merge is spread over the workers. Returns the concatenated results of
+    the partitions, each sorted if ordered; sorting them as a whole then
+    merges the few sorted runs in linear time.
+    """
+    import functools
+    import multiprocessing
+    import shutil
+    import tempfile
+    if not files:
+        return []
+    spill_dir = tempfile.mkdtemp(dir=temp_dir, prefix=".setop-")
+    try:
+        tasks = scatter_tasks(files, jobs, spill_dir)
+        with multiprocessing.Pool(jobs) as pool:
+            spill_paths = [[[] for _ in files] for _ in range(jobs)]
+            scattered = pool.map(functools.partial(scatter_range, spill_dir, jobs), tasks)
+            for (number, _, _), spills in zip(tasks, scattered):
+                for partition, path in spills:
+                    spill_paths[partition][number].append(path)
+            results = pool.map(functools.partial(reduce_partition, set_impl, function, ordered),
+                               spill_paths)
+    finally:
+        shutil.rmtree(spill_dir)
+    return list(itertools.chain.from_iterable(results))
+
+
+def counted_product(counted_lists, delimiter):
+    """Cartesian product of lists of (line, count) pairs as (line, count) pairs."""
+    import math
+    for combination in itertools.product(*counted_lists):
+        yield (delimiter.join(line for line, _ in combination),
+               math.prod(count for _, count in combination))
+
+
+def product_line_counts(counted_lists, delimiter, order="sorted"):
+    """(line, count) pairs of the Cartesian product of (line, count) lists.
+
+    With sorted order the lists must be sorted, and the output is sorted by
+    construction: every list but the last is sorted by line + delimiter, which
+    orders the joined lines exactly as long as the delimiter is not empty and
+    does not occur in those lines. Otherwise the product is sorted as a whole.
+    Other orders keep the order of the lists.
+    """
+    if order != "sorted":
+        return counted_product(counted_lists, delimiter)
+    leading_lists = counted_lists[:-1]
+    if delimiter and not any(delimiter in line
+                             for counted_list in leading_lists
+                             for line, _ in counted_list):
+        for counted_list in leading_lists:
+            counted_list.sort(key=lambda item: item[0] + delimiter)
+        return counted_product(counted_lists, delimiter)
+    return combine_counts(sorted(counted_product(counted_lists, delimiter)))
+
+
+def product_lines(set_impl, counted_lists, delimiter, order="sorted"):
+    """Lines of the Cartesian product of (line, count) lists, generated lazily.
+
+    Set mode keeps the order of the lists; see product_line_counts() for
+    multiset mode.
+    """
+    if set_impl != MultiSet:
+        line_lists = [[line for line, _ in counted_list] for counted_list in counted_lists]
+        return (delimiter.join(t) for t in itertools.product(*line_lists))
+    return expand_line_counts(product_line_counts(counted_lists, delimiter, order))
+
+
+def digest_array(lines, digest_size):
+    """NumPy array of digest_size-byte digests of lines, one per line."""
+    import hashlib
+    import numpy
+    digests = bytearray()
+    for line in lines:
+        digests += hashlib.blake2b(line, digest_size=digest_size).digest()
+    dtype = numpy.uint64 if digest_size == 8 else numpy.dtype("S%d" % digest_size)
+    return numpy.frombuffer(digests, dtype=dtype)
+
+
+def line_keys(lines, digest_size):
+    """NumPy array of digest_size-byte keys of a list of lines, for comparing
+    lines within one run: Python's (randomized) 64-bit hash for 8 bytes, which
+    is much faster to compute than a digest, or otherwise digests."""
+    import numpy
+    if digest_size == 8:
+        return numpy.fromiter(map(hash, lines), dtype=numpy.int64, count=len(lines))
+    return digest_array(lines, digest_size)
+
+
+def sorted_unique(array):
+    """Sorted, unique elements of a NumPy array."""
+    import numpy
+    array = numpy.sort(array)
+    unique = numpy.ones(len(array), dtype=bool)
+    numpy.not_equal(array[1:], array[:-1], out=unique[1:])
+    return array[unique]
+
+
+def file_digests(file, digest_size):
+    """Sorted, unique keys (see line_keys) of non-empty lines of a file."""
+    import numpy
+    keys = [line_keys([line for line in split_lines(chunk) if line], digest_size)
+            for chunk in read_chunks(file)]
+    return sorted_unique(numpy.concatenate(keys) if keys else line_keys([], digest_size))
+
+
+def digest_lines(file, survivors, digest_size):
+    """Generate the non-empty lines of a file whose keys (see line_keys) are in
+    the sorted array survivors, each once, in the order they first appear."""
+    import numpy
+    if not len(survivors):
+        return
+    # Lines are looked up by binary search in the sorted survivors.
+    generated = numpy.zeros(len(survivors), dtype=bool)
+    remaining = len(survivors)
+    for chunk in read_chunks(file):
+        lines = [line for line in split_lines(chunk) if line]
+        digests = line_keys(lines, digest_size)
+        positions = numpy.searchsorted(survivors, digests)
+        positions[positions == len(survivors)] = 0
+        found = numpy.flatnonzero((survivors[positions] == digests) & ~generated[positions])
+        _, first_found = numpy.unique(positions[found], return_index=True)
+        found = numpy.sort(found[first_found])
+        generated[positions[found]] = True
+        yield from map(lines.__getitem__, found.tolist())
+        remaining -= len(found)
+        if not remaining:
+            break
+
+
+def hashed_reduce_line_sets(files, function, digest_size):
+    """Lines of intersection or difference of files, computed on digests.
+
+    Lines are represented by fixed-size digests in NumPy arrays during the
+    reduction; surviving lines are recovered by scanning the first file again,
+    and generated lazily in the order they first appear there. Distinct lines
+    with colliding digests are treated as equal.
+
+    Only digests are held in memory, so memory is saved as long as the result
+    is small or streamed; sorting the output holds all result lines again.
+    """
+    import numpy
+    if not files:
+        return iter(())
+    first, *others = files
+    survivors = file_digests(first, digest_size)
+    for file in others:
+        digests = file_digests(file, digest_size)
+        if function == operator.and_:
+            survivors = numpy.intersect1d(survivors, digests, assume_unique=True)
+        else:
+            survivors = numpy.setdiff1d(survivors, digests, assume_unique=True)
+    first.seek(0)
+    return digest_lines(first, survivors, digest_size)
+
+
+BLOOM_MAGIC = b"setop-bloom-1"
+
+
+def line_digests(lines):
+    """Pairs of 64-bit hashes of lines, as an (n, 2) array of little-endian
+    uint64, taken from 128-bit digests so they are stable across runs."""
+    return digest_array(lines, 16).view("<u8").reshape(-1, 2)
+
+
+class BloomFilter:
+    """Bloom filter of lines: a NumPy bit array in which each line sets
+    hash_count bits, at positions derived from its digest by double hashing.
+    """
+    def __init__(self, bits, hash_count):
+        self.bits = bits
+        self.size = 8 * len(bits)
+        self.hash_count = hash_count
+    
+    @classmethod
+    def for_capacity(cls, capacity, error_rate):
+        """Empty filter sized to hold capacity lines at the given false
+        positive rate."""
+        import math
+        import numpy
+        capacity = max(capacity, 1)
+        size = max(64, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        hash_count = max(1, round(size / capacity * math.log(2)))
+        return cls(numpy.zeros((size + 7) // 8, dtype=numpy.uint8), hash_count)
+    
+    def positions(self, digests):
+        """Bit positions of lines with given digests, one row per line."""
+        import numpy
+        steps = numpy.arange(self.hash_count, dtype=numpy.uint64)
+        # uint64 arithmetic wraps around, which keeps the positions well mixed.
+        positions = digests[:, :1] + steps * (digests[:, 1:] | numpy.uint64(1))
+        return positions % numpy.uint64(self.size)
+    
+    def add(self, digests):
+        import numpy
+        positions = self.positions(digests)
+        masks = numpy.left_shift(numpy.uint8(1), (positions & numpy.uint64(7)).astype(numpy.uint8))
+        numpy.bitwise_or.at(self.bits, positions >> numpy.uint64(3), masks)
+    
+    def contains(self, digests):
+        """Boolean array telling which lines may be in the filter."""
+        import numpy
+        positions = self.positions(digests)
+        found = self.bits[positions >> numpy.uint64(3)] >> (positions & numpy.uint64(7))
+        return (found & 1).all(axis=1)
+    
+    def save(self, path):
+        with open(path, "wb") as fp:
+            fp.write(b"%s\t%d\t%d\n" % (BLOOM_MAGIC, self.size, self.hash_count))
+            fp.write(self.bits.tobytes())
+    
+    @classmethod
+    def load(cls, path):
+        """Memory-map a filter saved by save(). Raises OSError for other files."""
+        import numpy
+        with open(path, "rb") as fp:
+            header = fp.readline()
+            offset = fp.tell()
+        fields = header.split()
+        if len(fields) != 3 or fields[0] != BLOOM_MAGIC:
+            raise OSError("%s is not a setop Bloom filter" % path)
+        size, hash_count = int(fields[1]), int(fields[2])
+        bits = numpy.memmap(path, dtype=numpy.uint8, mode="r", offset=offset)
+        if 8 * len(bits) != size:
+            raise OSError("Bloom filter %s is truncated" % path)
+        return cls(bits, hash_count)
+
+
+def digest_chunks(file):
+    """Generate non-empty lines of a file and their digests, per chunk."""
+    for chunk in read_chunks(file):
+        lines = [line for line in split_lines(chunk) if line]
+        yield lines, line_digests(lines)
+
+
+def build_bloom_filter(files, error_rate):
+    """Bloom filter of the non-empty lines of files.
+
+    The filter is sized by counting the lines of seekable files first;
+    digests of other files (like stdin) are held in memory meanwhile, one
+    array per chunk, and added chunk by chunk.
+    """
+    capacity, pending = 0, []
+    for file in files:
+        if file.seekable():
+            start = file.tell()
+            capacity += sum(chunk.count(b"\n") + (not chunk.endswith(b"\n"))
+                            for chunk in read_chunks(file))
+            file.seek(start)
+        else:
+            for _, digests in digest_chunks(file):
+                pending.append(digests)
+                capacity += len(digests)
+    bloom = BloomFilter.for_capacity(capacity, error_rate)
+    while pending:
+        bloom.add(pending.pop())
+    for file in files:
+        if file.seekable():
+            for _, digests in digest_chunks(file):
+                bloom.add(digests)
+    return bloom
+
+
+def approx_reduce_line_sets(files, function, error_rate, verify=False, save_filter=None,
+                            load_filter=None):
+    """Lines of intersection or difference of files, tested against Bloom filters
+    of all files but the first, which is streamed.
+
+    Difference uses one filter of all other files, intersection one filter per
+    file; a filter loaded from load_filter is used in addition to them, and
+    the filter built from the files can be written to save_filter. Lines are
+    returned in the order they first appear in the first file.
+
+    Without verify, false positives of the filters make lines wrongly appear in
+    an intersection or disappear from a difference. With verify, the lines the
+    filters found are checked exactly in a second pass over the other files.
+    """
+    import numpy
+    if not files:
+        return []
+    first, *others = files
+    if verify and not all(file.seekable() for file in others):
+        raise ValueError("Verification requires the files after the first to be seekable")
+    if verify and load_filter is not None:
+        raise ValueError("Lines found in a loaded filter cannot be verified")
+    if function == operator.and_:
+        filters = [build_bloom_filter([file], error_rate) for file in others]
+    else:
+        filters = [build_bloom_filter(others, error_rate)] if others else []
+    if save_filter is not None:
+        if len(filters) != 1:
+            raise ValueError("Only a filter of exactly one file can be saved in "
+                             "intersection mode")
+        filters[0].save(save_filter)
+    if load_filter is not None:
+        filters.append(BloomFilter.load(load_filter))
+    
+    # Lines of the first file which pass the filters, or for a verified
+    # difference all lines, mapped to whether the filters found them.
+    output_lines = {}
+    for lines, digests in digest_chunks(first):
+        if function == operator.and_:
+            found = numpy.ones(len(lines), dtype=bool)
+            for bloom in filters:
+                found &= bloom.contains(digests)
+            output_lines.update(dict.fromkeys(itertools.compress(lines, found.tolist()), True))
+        else:
+            found = numpy.zeros(len(lines), dtype=bool)
+            for bloom in filters:
+                found |= bloom.contains(digests)
+            if verify:
+                output_lines.update(zip(lines, found.tolist()))
+            else:
+                output_lines.update(dict.fromkeys(itertools.compress(lines, (~found).tolist()),
+                                                  False))
+    
+    if verify and function == operator.and_:
+        result = OrderedSet(output_lines)
+        for file in others:
+            file.seek(0)
+            intersect_lines(result, read_lines(file))
+        return list(result)
+    if verify:
+        candidates = {line for line, found in output_lines.items() if found}
+        confirmed = set()
+        for file in others:
+            file.seek(0)
+            confirmed.update(filter(candidates.__contains__, read_lines(file)))
+        return [line for line in output_lines if line not in confirmed]
+    return list(output_lines)
+
+
+# Number of hash values kept per input by BottomKSketch.
+SKETCH_SIZE = 4096
+
+
+def stable_hashes(lines):
+    """Signed 64-bit hashes of lines, taken from their BLAKE2b digests so that,
+    unlike Python's hash, they are the same in every process."""
+    import array
+    import hashlib
+    hashes = array.array("q", b"".join([hashlib.blake2b(line, digest_size=8).digest()
+                                        for line in lines]))
+    if sys.byteorder == "big":
+        hashes.byteswap()
+    return hashes
+
+
+class BottomKSketch:
+    """Sketch of the distinct lines of an input: the k smallest of their hashes,
+    as signed 64-bit integers (see stable_hashes).
+    """
+    def __init__(self, k=SKETCH_SIZE):
+        self.k = k
+        self.values = set()
+        self.heap = []  # negated values, so that the largest one is on top
+        self.threshold = sys.maxsize
+    
+    def update(self, lines):
+        import heapq
+        for chunk in lines:
+            for value in filter(self.threshold.__gt__, stable_hashes(chunk)):
+                if value >= self.threshold or value in self.values:
+                    continue
+                self.values.add(value)
+                heapq.heappush(self.heap, -value)
+                if len(self.heap) > self.k:
+                    self.values.discard(-heapq.heappop(self.heap))
+                if len(self.heap) == self.k:
+                    self.threshold = -self.heap[0]
+
+
+def file_sketch(file):
+    """Bottom-k sketch of the non-empty lines of a file."""
+    sketch = BottomKSketch()
+    sketch.update(filter(None, split_lines(chunk)) for chunk in read_chunks(file))
+    return sketch
+
+
+def estimate_cardinality(sketches, function):
+    """Estimate size of the result of function applied to sketched inputs.
+
+    Returns the estimated number of distinct result lines and the estimated
+    Jaccard index (size of intersection / size of union) of the inputs.
+    """
+    import heapq
+    if not sketches:
+        return 0, 0.0
+    k = sketches[0].k
+    union = heapq.nsmallest(k, set().union(*(sketch.values for sketch in sketches)))
+    if not union:
+        return 0, 0.0
+    if len(union) < k:
+        union_size = len(union)
+    else:
+        union_size = (k - 1) / ((union[-1] + 2 ** 63) / 2 ** 64)
+
+    first, *others = sketches
+    in_all = [value for value in union
+              if all(value in sketch.values for sketch in sketches)]
+    if function == operator.or_:
+        selected = union
+    elif function == operator.and_:
+        selected = in_all
+    else:
+        selected = [value for value in union
+                    if value in first.values
+                    and not any(value in sketch.values for sketch in others)]
+    return (round(union_size * len(selected) / len(union)),
+            len(in_all) / len(union))
+
+
+def output_compressor(compression):
+    """Streaming compressor object (with compress and flush) for a format."""
+    import zlib
+    import bz2
+    import lzma
+    if compression == "gzip":
+        return zlib.compressobj(wbits=31)
+    elif compression == "bz2":
+        return bz2.BZ2Compressor()
+    elif compression == "xz":
+        return lzma.LZMACompressor()
+    else:
+        return zstd_module().ZstdCompressor().compressobj()
+
+
+class LineWriter:
+    """Write lines to a file descriptor in large joined chunks, optionally
+    compressing them.
+
+    Counts the lines and (uncompressed) bytes written, for throughput reporting.
+    """
+    def __init__(self, fd, EOL, buffer_size=OUTPUT_BUFFER_SIZE, compressor=None):
+        self.fd = fd
+        self.EOL = EOL
+        self.buffer_size = buffer_size
+        self.compressor = compressor
+        self.buffer = bytearray()
+        self.lines_written = 0
+        self.bytes_written = 0
+    
+    def write_lines(self, lines):
+        lines = iter(lines)
+        while True:
+            batch = list(itertools.islice(lines, OUTPUT_BATCH_LINES))
+            if not batch:
+                break
+            self.buffer += self.EOL.join(batch)
+            self.buffer += self.EOL
+            self.lines_written += len(batch)
+            if len(self.buffer) >= self.buffer_size:
+                self.flush()
+    
+    def flush(self):
+        # The buffer is taken before writing, so a failed write is not retried.
+        buffer, self.buffer = self.buffer, bytearray()
+        self.bytes_written += len(buffer)
+        if self.compressor is not None:
+            self._write(self.compressor.compress(bytes(buffer)))
+        else:
+            self._write(buffer)
+    
+    def close(self):
+        self.flush()
+        if self.compressor is not None:
+            self._write(self.compressor.flush())
+            self.compressor = None
+    
+    def _write(self, data):
+        data = memoryview(data)
+        while data:
+            written = os.write(self.fd, data)
+            data = data[written:]
+
+
+def peak_rss():
+    """Peak resident set size in KiB of this process and its finished child
+    processes, or None where it cannot be measured.
+
+    On Linux, the peak of this process is read from /proc: its ru_maxrss
+    starts at the peak of the process it was forked from.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    scale = 1024 if sys.platform == "darwin" else 1
+    usage = [resource.getrusage(who).ru_maxrss // scale
+             for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    try:
+        with open("/proc/self/status", "rb") as status:
+            for line in status:
+                if line.startswith(b"VmHWM:"):
+                    usage[0] = int(line.split()[1])
+    except OSError:
+        pass
+    return sum(usage)
+
+
+class Phase:
+    """Context manager adding the wall and CPU time spent in it to a phase of
+    RunStats; does nothing without stats."""
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+    
+    def __enter__(self):
+        self.wall_start, self.cpu_start = time.perf_counter(), time.process_time()
+    
+    def __exit__(self, *exc_info):
+        if self.stats is not None:
+            wall, cpu = self.stats.phases.get(self.name, (0.0, 0.0))
+            self.stats.phases[self.name] = (wall + time.perf_counter() - self.wall_start,
+                                            cpu + time.process_time() - self.cpu_start)
+
+
+class RunStats:
+    """Wall and CPU time of the phases of a run, for --stats.
+
+    Streaming engines do most of their work lazily while output is written,
+    so it is accounted to the write phase.
+    """
+    def __init__(self):
+        self.phases = {}
+    
+    def report(self, files, writer, stats_format):
+        """Format statistics of phases, input files and output as text or JSON."""
+        import json
+        stats = dict(phases={name: dict(wall=round(wall, 6), cpu=round(cpu, 6))
+                             for name, (wall, cpu) in self.phases.items()},
+                     inputs=[file.stats() for file in files],
+                     output=dict(lines=writer.lines_written, bytes=writer.bytes_written),
+                     peak_rss_kib=peak_rss())
+        if stats_format == "json":
+            return json.dumps(stats, indent=2) + "\n"
+        text = ["phase=%s wall=%.3f cpu=%.3f\n" % (name, phase["wall"], phase["cpu"])
+                for name, phase in stats["phases"].items()]
+        text += ["input=%s lines=%s bytes=%s distinct=%s duplicates=%s passes=%d "
+                 "wall=%.3f cpu=%.3f\n"
+                 % (file["name"], *("-" if file[field] is None else file[field]
+                                    for field in ("lines", "bytes", "distinct", "duplicates")),
+                    file["passes"], file["wall"], file["cpu"])
+                 for file in stats["inputs"]]
+        text.append("output lines=%d bytes=%d\n" % (writer.lines_written, writer.bytes_written))
+        text.append("peak_rss_kib=%s\n" % ("-" if stats["peak_rss_kib"] is None
+                                             else stats["peak_rss_kib"]))
+        return "".join(text)
+
+
+OPERATIONS = dict(union=operator.or_,
+                  sum=operator.add,
+                  intersection=operator.and_,
+                  difference=operator.sub)
+
+
+def evaluate(mode, files, set_impl=set, output="lines", order="sorted", delimiter=b"\t",
+             key=None, separator=None, memory_limit=None, temp_dir=None, presorted=False,
+             jobs=1, hash_keys=None, index=False, index_dir=None, stats=None, expression=None,
+             approx=None, verify=False, save_filter=None, load_filter=None):
+    """Compute a set operation (union, sum, intersection, difference or product)
+    of binary input files, or, for mode "expression", a set expression of them.
+
+    Returns an iterator of output lines, or, depending on output, an iterator
+    of (line, count) pairs ("counts"), the number of output lines ("count"),
+    or the estimated cardinality and Jaccard index ("estimate"). Streaming
+    engines read their inputs while the returned iterator is consumed.
+
+    Raises ValueError for invalid combinations of options.
+    """
+    separator = separator if separator is not None else delimiter
+    
+    # The memory limit of the index engine applies to building indexes.
+    engines = [option for option, enabled in (("--presorted", presorted),
+                                              ("--memory-limit", memory_limit is not None
+                                                                 and not index),
+                                              ("--jobs", jobs > 1),
+                                              ("--hash-keys", hash_keys is not None),
+                                              ("--index", index),
+                                              ("--approx", approx is not None))
+               if enabled]
+    if mode == "sum" and set_impl != MultiSet:
+        raise ValueError("Sum is available in multiset mode only")
+    if len(engines) > 1:
+        raise ValueError("Options %s cannot be combined" % " and ".join(engines))
+    if mode == "product" and engines and not index:
+        raise ValueError("Option %s is not available in product mode" % engines[0])
+    if hash_keys is not None:
+        if mode not in ("intersection", "difference") or set_impl == MultiSet:
+            raise ValueError("Hashed keys are available in intersection and "
+                             "difference set mode only")
+        if files and not files[0].seekable():
+            raise ValueError("Hashed keys require the first file to be seekable")
+        if not numpy_available():
+            raise ValueError("Hashed keys require NumPy")
+    if approx is not None:
+        if mode not in ("intersection", "difference") or set_impl == MultiSet:
+            raise ValueError("Approximate membership is available in intersection and "
+                             "difference set mode only")
+        if not numpy_available():
+            raise ValueError("Approximate membership requires NumPy")
+    elif verify or save_filter is not None or load_filter is not None:
+        raise ValueError("Options --verify, --save-filter and --load-filter require --approx")
+    
+    if order == "first-seen":
+        if set(engines) - {"--hash-keys", "--approx"}:
+            raise ValueError("Option %s cannot be combined with first-seen order" % engines[0])
+        if set_impl == set:
+            set_impl = OrderedSet
+    if key is not None:
+        if mode not in ("union", "intersection", "difference"):
+            raise ValueError("Key fields are available in union, intersection and "
+                             "difference mode only")
+        if len(separator) != 1:
+            raise ValueError("Field separator must be a single character")
+        if engines or output == "estimate":
+            raise ValueError("Key fields cannot be combined with %s"
+                             % (engines[0] if engines else "--estimate"))
+    if mode == "expression":
+        if engines or key is not None or output == "estimate":
+            raise ValueError("Expressions cannot be combined with %s"
+                             % (engines[0] if engines else "--key" if key is not None
+                                else "--estimate"))
+        tree = parse_expression(expression, [file.name for file in files])
+        if operator.add in expression_functions(tree) and set_impl != MultiSet:
+            raise ValueError("Sum is available in multiset mode only")
+    if output == "counts" and set_impl != MultiSet:
+        raise ValueError("Counts are available in multiset mode only")
+    if output == "estimate":
+        if mode not in ("union", "intersection", "difference") or set_impl == MultiSet:
+            raise ValueError("Estimates are available in union, intersection and "
+                             "difference set mode only")
+        if engines:
+            raise ValueError("Option %s cannot be combined with estimates" % engines[0])
+    
+    if index:
+        import functools
+        load_options = dict(index_dir=index_dir, memory_limit=memory_limit, temp_dir=temp_dir)
+        load = functools.partial(indexed_line_set, **load_options)
+        load_counts = functools.partial(indexed_line_counts, **load_options)
+    else:
+        load, load_counts = line_set, line_counts
+    
+    # Each branch produces either a collection of lines (result), a stream of
+    # (line, count) pairs (counted_lines), or a final value.
+    result = counted_lines = None
+    with Phase(stats, "load"):
+        if output == "estimate":
+            sketches = [file_sketch(file) for file in files]
+            return estimate_cardinality(sketches, OPERATIONS[mode])
+        elif mode == "expression":
+            result = evaluate_expression(set_impl, files, tree, order != "first-seen")
+        elif key is not None:
+            result = keyed_reduce_line_sets(set_impl, files, OPERATIONS[mode],
+                                            key_pattern(key, separator))
+        elif mode in OPERATIONS and presorted:
+            counted_lines = merge_sorted_files(set_impl, files, OPERATIONS[mode])
+        elif mode in OPERATIONS and memory_limit is not None and not index:
+            counted_lines = external_reduce_line_sets(set_impl, files, OPERATIONS[mode],
+                                                      memory_limit, temp_dir)
+        elif mode in OPERATIONS and hash_keys is not None:
+            result = hashed_reduce_line_sets(files, OPERATIONS[mode], hash_keys // 8)
+        elif mode in OPERATIONS and approx is not None:
+            result = approx_reduce_line_sets(files, OPERATIONS[mode], approx, verify,
+                                             save_filter, load_filter)
+        elif mode in OPERATIONS and jobs > 1:
+            reduced = parallel_reduce_line_sets(set_impl, files, OPERATIONS[mode], jobs,
+                                                order == "sorted", temp_dir)
+            if set_impl == MultiSet:
+                counted_lines = sorted(reduced) if order == "sorted" else reduced
+            else:
+                result = reduced
+        elif mode in ("intersection", "difference") and not index:
+            result = probe_reduce_line_sets(set_impl, files, OPERATIONS[mode],
+                                            order != "first-seen")
+        elif mode in OPERATIONS:
+            result = reduce_line_sets(set_impl, files, OPERATIONS[mode], load)
+        elif output == "count":
+            import math
+            counted_lists = [load_counts(set_impl, file) for file in files]
+            return math.prod(sum(count for _, count in counted_list)
+                             if set_impl == MultiSet else len(counted_list)
+                             for counted_list in counted_lists)
+        elif order == "sorted":
+            counted_lists = [load_counts(set_impl, file) for file in files]
+        else:
+            counted_lists = [unsorted_counts(load(set_impl, file)) for file in files]
+    
+    with Phase(stats, "sort"):
+        if mode == "product":
+            if output == "counts":
+                counted_lines = product_line_counts(counted_lists, delimiter, order)
+            else:
+                return product_lines(set_impl, counted_lists, delimiter, order)
+        elif output == "count":
+            if result is not None:
+                return len(result) if hasattr(result, "__len__") else sum(1 for _ in result)
+            return sum(count for _, count in counted_lines)
+        elif result is not None and output == "counts":
+            counted_lines = (sorted_counts(result) if order == "sorted"
+                             else unsorted_counts(result))
+        elif result is not None:
+            return iter(sorted_lines(result) if order == "sorted" else result)
+        
+        if output == "counts":
+            return iter(counted_lines)
+        return expand_line_counts(counted_lines)
+
+
+def library_input(input_, encoding):
+    """Binary input file for a path, a file object or an iterable of lines.
+    Returns the file and whether it was opened here."""
+    if isinstance(input_, (str, bytes, os.PathLike)):
+        return open_input(open(input_, "rb")), True
+    if hasattr(input_, "read"):
+        return open_input(input_), False
+    return IterableInput(input_, encoding or "utf-8"), False
+
+
+def set_operation(mode, inputs, multiset=False, order="sorted", counts=False,
+                  encoding=None, delimiter="\t", key=None, field_separator=None, **options):
+    """Generate output lines of a set operation of inputs; see union."""
+    opened = []
+    try:
+        files = []
+        for input_ in inputs:
+            file, is_opened = library_input(input_, encoding)
+            files.append(file)
+            if is_opened:
+                opened.append(file)
+        if isinstance(delimiter, str):
+            delimiter = delimiter.encode(encoding or "utf-8")
+        if isinstance(field_separator, str):
+            field_separator = field_separator.encode(encoding or "utf-8")
+        output = evaluate(mode, files, MultiSet if multiset else set,
+                          "counts" if counts else "lines", order, delimiter,
+                          key, field_separator, **options)
+        if encoding is None:
+            yield from output
+        elif counts:
+            yield from ((line.decode(encoding), count) for line, count in output)
+        else:
+            yield from (line.decode(encoding) for line in output)
+    finally:
+        for file in opened:
+            source_file(file).close()
+
+
+def union(*inputs, **options):
+    """Lazily generate lines which are in any of the inputs.
+
+    Inputs are paths (str, bytes or os.PathLike; compressed files are
+    decompressed), binary file objects, or iterables of bytes or str lines
+    (str lines are encoded with encoding, or UTF-8). Output lines are bytes,
+    or str decoded with encoding if it is given. Inputs are opened and read,
+    and invalid options raise ValueError, once iteration starts.
+
+    Options:
+        multiset -- count duplicate lines (max of counts for union)
+        order -- "sorted" (default), "none" or "first-seen"
+        counts -- generate (line, count) pairs instead (multiset only)
+        key, field_separator -- compare lines on one field only
+        memory_limit, temp_dir, presorted, jobs, hash_keys, index, index_dir
+            -- alternative engines, as the command line options
+    """
+    return set_operation("union", inputs, **options)
+
+
+def intersection(*inputs, **options):
+    """Lazily generate lines which are in all inputs; see union."""
+    return set_operation("intersection", inputs, **options)
+
+
+def difference(*inputs, **options):
+    """Lazily generate lines of the first input which are in none of the
+    others; see union."""
+    return set_operation("difference", inputs, **options)
+
+
+def multiset_sum(*inputs, **options):
+    """Lazily generate lines of all inputs, summing their counts; see union.
+    Implies multiset mode."""
+    return set_operation("sum", inputs, multiset=True, **options)
+
+
+def set_expression(expression, *inputs, **options):
+    """Lazily generate lines of a set expression of inputs, like
+    "($1 | $2) - (c & d)"; see union and the --expr option."""
+    return set_operation("expression", inputs, expression=expression, **options)
+
+
+def product(*inputs, **options):
+    """Lazily generate the Cartesian product of lines of the inputs, joined by
+    delimiter (default TAB); see union."""
+    return set_operation("product", inputs, **options)
+
+
+class Arguments:
+    """Parsed command line arguments of the fast path of SetOp.parse_simple_args."""
+    def __init__(self, **values):
+        self.__dict__.update(values)
+
+
+# Default line separator, according to the detected OS.
+NEWLINE_MODE = "windows" if sys.platform == "win32" else "unix"
+
+# Options understood by SetOp.parse_simple_args, with the attribute and value
+# they set; other command lines are parsed by the full argparse parser.
+SIMPLE_FLAGS = {"-u": ("mode", "union"), "--union": ("mode", "union"),
+                "-i": ("mode", "intersection"), "--intersection": ("mode", "intersection"),
+                "-d": ("mode", "difference"), "--difference": ("mode", "difference"),
+                "-p": ("mode", "product"), "--product": ("mode", "product"),
+                "-s": ("mode", "sum"), "--sum": ("mode", "sum"),
+                "-m": ("set_implementation", MultiSet),
+                "--multiset": ("set_implementation", MultiSet),
+                "-c": ("count", True), "--count": ("count", True)}
+
+
 class SetOp:
     def __init__(self):
-        newline_mode = "windows" if sys.platform == "win32" else "unix"
-                
-        self.parser = parser = argparse.ArgumentParser(description=__doc__,
-                                                       formatter_class=argparse.RawTextHelpFormatter)
+        self._parser = None
+    
+    @property
+    def parser(self):
+        """The full argument parser, built on first use."""
+        if self._parser is None:
+            self._parser = self.build_parser()
+        return self._parser
+    
+    def build_parser(self):
+        import argparse
+        newline_mode = NEWLINE_MODE
+        
+        parser = argparse.ArgumentParser(description=__doc__,
+                                         formatter_class=argparse.RawTextHelpFormatter)
         mode = parser.add_mutually_exclusive_group(required=True)
         mode.add_argument("-u", "--union",
                           dest="mode", action="store_const", const="union",
@@ -128,6 +2099,17 @@ class SetOp:
         mode.add_argument("-p", "--product",
                           dest="mode", action="store_const", const="product",
                           help="lines(file1) x lines(file2) x lines(file3) ...")
+        mode.add_argument("-E", "--expr",
+                          dest="expression", default=None,
+                          metavar="expression",
+                          help="evaluate a set expression of the input files, like\n"
+                               "\"($1 | $2) - (c & d)\"; operands are $N (N-th file) or\n"
+                               "file names, with or without extension, which may contain\n"
+                               "operators and spaces (the longest matching name wins) or\n"
+                               "be quoted ('my file'); operators are | (union),\n"
+                               "& (intersection), - (difference) and + (sum, multiset\n"
+                               "mode only), with Python precedence; each file is read\n"
+                               "once, and files used once are streamed where possible")
         mode.add_argument("-s", "--sum",
                           dest="mode", action="store_const", const="sum",
                           help="lines(file1) + lines(file2) + lines(file3) ... "
@@ -146,41 +2128,265 @@ class SetOp:
                             dest="set_implementation", action="store_const",
                             const=MultiSet, default=set,
                             help="multiset mode (allow duplicate elements)")
+        parser.add_argument("-k", "--key",
+                            type=positive_int, default=None,
+                            metavar="field",
+                            help="compare lines on their field-th field only and output\n"
+                                 "whole lines, taken from the first file for -i and -d\n"
+                                 "(union, intersection and difference only)")
+        parser.add_argument("-t", "--field-separator",
+                            default=None,
+                            metavar="separator",
+                            help="single character separating fields for --key\n"
+                                 "(default: the product mode delimiter)")
+        parser.add_argument("--memory-limit",
+                            type=parse_size, default=None,
+                            metavar="size",
+                            help="sort bounded runs of input lines to temporary files\n"
+                                 "and merge them instead of holding all input in memory;\n"
+                                 "size is in bytes, optionally with K, M, G or T suffix\n"
+                                 "(not available in product mode)")
+        parser.add_argument("--temp-dir",
+                            default=None,
+                            metavar="directory",
+                            help="directory for temporary files (default: system default)")
+        parser.add_argument("--presorted",
+                            action="store_true",
+                            help="inputs are already sorted (LC_ALL=C sort); merge them in\n"
+                                 "a single streaming pass using little memory\n"
+                                 "(not available in product mode)")
+        parser.add_argument("-j", "--jobs",
+                            type=positive_int, default=1,
+                            metavar="N",
+                            help="hash-partition byte ranges of the inputs into spill\n"
+                                 "files (in --temp-dir) and reduce the partitions in N\n"
+                                 "parallel processes; the total work is up to 1.5 times\n"
+                                 "that of one process, while merging and writing the\n"
+                                 "output stays serial (not available in product mode)")
+        parser.add_argument("--hash-keys",
+                            type=int, choices=[64, 128], default=None,
+                            metavar="bits",
+                            help="represent lines by 64 or 128 bit digests in NumPy arrays\n"
+                                 "to save memory when the result is small or not sorted\n"
+                                 "(--order none or first-seen); the first file must be a\n"
+                                 "regular file (intersection and difference only;\n"
+                                 "requires NumPy)")
+        parser.add_argument("--approx",
+                            type=probability, default=None,
+                            metavar="FPR",
+                            help="stream the first file through Bloom filters of the other\n"
+                                 "files with false positive rate FPR instead of holding\n"
+                                 "them in memory (intersection and difference set mode\n"
+                                 "only; requires NumPy)")
+        parser.add_argument("--verify",
+                            action="store_true",
+                            help="check lines found by --approx filters exactly, in a second\n"
+                                 "pass over the other files")
+        parser.add_argument("--save-filter",
+                            default=None,
+                            metavar="file",
+                            help="save the --approx filter of the other files to file")
+        parser.add_argument("--load-filter",
+                            default=None,
+                            metavar="file",
+                            help="also test lines against a filter saved by --save-filter")
+        parser.add_argument("--index",
+                            action="store_true",
+                            help="read input files through persistent indexes of their\n"
+                                 "sorted, distinct lines, building or rebuilding them as\n"
+                                 "needed (stored next to the files, or in --index-dir);\n"
+                                 "files whose index can be neither read nor written are\n"
+                                 "read directly")
+        parser.add_argument("--index-dir",
+                            default=None,
+                            metavar="directory",
+                            help="directory for input file indexes")
+        parser.add_argument("--order",
+                            choices=["sorted", "none", "first-seen"], default="sorted",
+                            help="order of output lines: sorted, none (as they come, which\n"
+                                 "skips sorting) or first-seen (in the order lines first\n"
+                                 "appear in the inputs) (default: sorted)")
+        result = parser.add_mutually_exclusive_group()
+        result.add_argument("--counts",
+                            action="store_true",
+                            help="print each distinct output line once, preceded by its\n"
+                                 "count and TAB, like uniq -c (multiset mode only)")
+        result.add_argument("-c", "--count",
+                            action="store_true",
+                            help="print only the exact number of output lines")
+        result.add_argument("-e", "--estimate",
+                            action="store_true",
+                            help="print only the estimated number of distinct output lines\n"
+                                 "and Jaccard index of the inputs, computed from small\n"
+                                 "fixed-size sketches (set mode -u, -i, -d only)")
+        parser.add_argument("-o", "--output",
+                            default=None,
+                            metavar="file",
+                            help="write output to file instead of stdout")
+        parser.add_argument("-z", "--compress",
+                            choices=["gzip", "bz2", "xz", "zstd"], default=None,
+                            help="compress output (zstd requires the zstandard module);\n"
+                                 "compressed inputs are always detected and decompressed")
+        parser.add_argument("--buffer-size",
+                            type=parse_size, default=OUTPUT_BUFFER_SIZE,
+                            metavar="size",
+                            help="output buffer size, optionally with K, M, G or T suffix\n"
+                                 "(default: 1M)")
+        parser.add_argument("--report",
+                            action="store_true",
+                            help="print number of lines and bytes written and elapsed\n"
+                                 "time to stderr")
+        parser.add_argument("--stats",
+                            action="store_true",
+                            help="print wall and CPU time of the load, sort and write\n"
+                                 "phases, lines, bytes, distinct lines, duplicates, read\n"
+                                 "passes and read time of each input, and peak RSS to\n"
+                                 "stderr; streaming engines (--presorted, --memory-limit,\n"
+                                 "probed inputs of -i and -d) do most work in the write\n"
+                                 "phase, and distinct lines are only counted for inputs\n"
+                                 "loaded into memory; inputs read by --jobs workers or\n"
+                                 "through a current --index show \"-\" for lines and bytes")
+        parser.add_argument("--stats-format",
+                            choices=["text", "json"], default="text",
+                            help="format of --stats (default: text)")
+        parser.add_argument("--profile",
+                            default=None,
+                            metavar="file",
+                            help="write cProfile statistics of the run to file\n"
+                                 "(for python -m pstats)")
         parser.add_argument("files",
                             nargs="*", type=argparse.FileType("rb"),
                             metavar="file",
-                            help="input files (use \"-\" for stdin)")
+                            help="input files, optionally compressed with gzip, bzip2, xz\n"
+                                 "or zstd (use \"-\" for stdin)")
         parser.add_argument("-v", "--version",
                             action="version", version="setop v%d.%d" % __VERSION__)
+        return parser
+    
+    def parse_simple_args(self, args):
+        """Parse a command line of only a mode, -m, -c and input files without
+        building the full parser, which takes longer than a run on small
+        inputs. Returns None for other command lines, or when an input file
+        cannot be opened, to leave them (and error messages) to argparse.
+        """
+        values = dict(mode=None, delimiter="\t", newlines=NEWLINE_MODE, set_implementation=set,
+                      key=None, field_separator=None, memory_limit=None, temp_dir=None,
+                      presorted=False, jobs=1, hash_keys=None, index=False, index_dir=None,
+                      order="sorted", counts=False, count=False, estimate=False, output=None,
+                      compress=None, buffer_size=OUTPUT_BUFFER_SIZE, report=False,
+                      stats=False, stats_format="text", profile=None, expression=None,
+                      approx=None, verify=False, save_filter=None, load_filter=None)
+        paths = []
+        for arg in args:
+            if arg in SIMPLE_FLAGS:
+                name, value = SIMPLE_FLAGS[arg]
+                if name == "mode" and values["mode"] not in (None, value):
+                    return None
+                values[name] = value
+            elif arg == "-" or not arg.startswith("-"):
+                paths.append(arg)
+            else:
+                return None
+        if values["mode"] is None:
+            return None
+        
+        files = []
+        for path in paths:
+            try:
+                files.append(sys.stdin.buffer if path == "-" else open(path, "rb"))
+            except OSError:
+                for file in files:
+                    file.close()
+                return None
+        return Arguments(files=files, **values)
     
     def run(self, args):
-        arguments = self.parser.parse_args(args)
-        files = arguments.files
-        mode = arguments.mode
-        set_impl = arguments.set_implementation
-        delimiter = arguments.delimiter.encode("ascii")
+        start_time = time.perf_counter()
+        arguments = self.parse_simple_args(args)
+        if arguments is None:
+            arguments = self.parser.parse_args(args)
+        if arguments.profile is None:
+            self.execute(arguments, start_time)
+            return
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(self.execute, arguments, start_time)
+        finally:
+            profiler.dump_stats(arguments.profile)
+    
+    def execute(self, arguments, start_time):
+        try:
+            files = [open_input(file) for file in arguments.files]
+        except OSError as error:
+            self.parser.exit(1, "%s\n" % error)
+        run_stats = None
+        if arguments.stats:
+            files = [MeasuredInput(file) for file in files]
+            run_stats = RunStats()
         EOL = dict(unix=b"\n", windows=b"\r\n")[arguments.newlines]
-
-        if mode == "union":
-            output_lines = sorted(reduce_line_sets(set_impl, files, operator.or_))
-        elif mode == "sum":
-            if set_impl != MultiSet:
-                self.parser.exit(1, "Sum is available in multiset mode only\n")
-            output_lines = sorted(reduce_line_sets(set_impl, files, operator.add))
-        elif mode == "intersection":
-            output_lines = sorted(reduce_line_sets(set_impl, files, operator.and_))
-        elif mode == "difference":
-            output_lines = sorted(reduce_line_sets(set_impl, files, operator.sub))
-        elif mode == "product":
-            sorted_line_lists = map(lambda f: sorted(line_set(set_impl, f)), files)
-            output_lines = (delimiter.join(t)
-                            for t in itertools.product(*sorted_line_lists))
-            if set_impl == MultiSet:
-                output_lines = sorted(output_lines)
+        separator = arguments.field_separator
+        output = ("counts" if arguments.counts else "count" if arguments.count
+                  else "estimate" if arguments.estimate else "lines")
+        
+        mode = arguments.mode if arguments.expression is None else "expression"
+        try:
+            result = evaluate(mode, files, arguments.set_implementation, output,
+                              arguments.order, arguments.delimiter.encode("ascii"),
+                              arguments.key,
+                              separator.encode("ascii") if separator is not None else None,
+                              arguments.memory_limit, arguments.temp_dir, arguments.presorted,
+                              arguments.jobs, arguments.hash_keys, arguments.index,
+                              arguments.index_dir, run_stats, arguments.expression,
+                              arguments.approx, arguments.verify, arguments.save_filter,
+                              arguments.load_filter)
+        except (ValueError, OSError, UnsortedInputError) as error:
+            self.parser.exit(1, "%s\n" % error)
+        
+        if output == "estimate":
+            output_lines = [b"cardinality\t%d" % result[0], b"jaccard\t%.6f" % result[1]]
+        elif output == "count":
+            output_lines = [b"%d" % result]
+        elif output == "counts":
+            output_lines = (b"%d\t%s" % (count, line) for line, count in result)
+        else:
+            output_lines = result
+        
+        if arguments.output is not None:
+            try:
+                fd = os.open(arguments.output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+            except OSError as error:
+                self.parser.exit(1, "%s\n" % error)
+        else:
+            sys.stdout.flush()
+            fd = sys.stdout.fileno()
+        try:
+            compressor = (output_compressor(arguments.compress)
+                          if arguments.compress is not None else None)
+        except OSError as error:
+            self.parser.exit(1, "%s\n" % error)
+        writer = LineWriter(fd, EOL, arguments.buffer_size, compressor)
+        with Phase(run_stats, "write"):
+            try:
+                writer.write_lines(output_lines)
+                writer.close()
+            except BrokenPipeError:
+                # The reader is gone (e.g. head); stop quietly like other filters.
+                # Python would report the pipe again when flushing stdout at exit.
+                os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+                sys.exit(1)
+            except (UnsortedInputError, OSError) as error:
+                self.parser.exit(1, "%s\n" % error)
+            finally:
+                if arguments.output is not None:
+                    os.close(fd)
         
-        for line in output_lines:
-            sys.stdout.buffer.write(line)
-            sys.stdout.buffer.write(EOL)
+        if arguments.report:
+            sys.stderr.write("lines=%d bytes=%d seconds=%.3f\n"
+                             % (writer.lines_written, writer.bytes_written,
+                                time.perf_counter() - start_time))
+        if run_stats is not None:
+            sys.stderr.write(run_stats.report(files, writer, arguments.stats_format))
 
 
 if __name__ == "__main__":
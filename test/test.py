@@ -4,10 +4,24 @@
 import unittest
 import tempfile
 import os
+import sys
+import json
+import pstats
 import subprocess
+import gzip
+import bz2
+import lzma
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 SETOP = ["./setop.py"]
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import setop
+
 
 def mockfile_paths(*mockfiles):
     return map(lambda mockfile: mockfile.path, mockfiles)
@@ -242,6 +256,23 @@ class Test(unittest.TestCase):
         self.assertEqual(retcode, 0)
         self.assertEqual(output, sorted_output("foo", "bar", "baz"))
         
+        prefixes = MockupFile("a", "a!", "a", "b")
+        retcode, output = call_setop("-m", "-p", "-D", ":", prefixes.path, "-", self.c.path,
+                                     input_="z\ny\ny\n")
+        self.assertEqual(retcode, 0)
+        self.assertEqual(output, sorted_output(*("%s:%s:%s" % (p, q, r)
+                                                 for p in ("a", "a!", "a", "b")
+                                                 for q in ("z", "y", "y")
+                                                 for r in ("bar", "quux"))))
+        
+        delimited = MockupFile("a", "a:b", "a:")
+        retcode, output = call_setop("-m", "-p", "-D", ":", delimited.path, "-",
+                                     input_="a\n!\n")
+        self.assertEqual(retcode, 0)
+        self.assertEqual(output, sorted_output(*("%s:%s" % (p, q)
+                                                 for p in ("a", "a:b", "a:")
+                                                 for q in ("a", "!"))))
+        
         
     def test_multiset_sum(self):
         retcode, output = call_setop("-m", "-s", *mockfile_paths(self.x, self.y))
@@ -280,6 +311,636 @@ class Test(unittest.TestCase):
         retcode, output = call_setop_raw("-p", "--newlines", "windows", "-D", ",", *mockfile_paths(a, b))
         self.assertEqual(retcode, 0)
         self.assertEqual(output, b"AAA,XXX\r\nAAA,YYY\r\nBBB,XXX\r\nBBB,YYY\r\nCCC,XXX\r\nCCC,YYY\r\n")
+        
+        a = MockupFileRaw(b"AAA\r", b"B\rB", b"", b"\r", b"CCC\r\r", EOL=b"\n")
+        retcode, output = call_setop_raw("-u", "--newlines", "unix", "-", a.path,
+                                         input_=b"DDD\r\n\r\nAAA")
+        self.assertEqual(retcode, 0)
+        self.assertEqual(output, b"AAA\nB\rB\nCCC\nDDD\n")
+    
+    def test_memory_limit(self):
+        big = MockupFile(*("line%d" % (i % 700) for i in range(2000)))
+        for mode in (["-u"], ["-i"], ["-d"], ["-m", "-u"], ["-m", "-i"], ["-m", "-d"], ["-m", "-s"]):
+            paths = list(mockfile_paths(big, self.x, self.a, self.y))
+            _, expected = call_setop(*(mode + paths))
+            retcode, output = call_setop(*(mode + ["--memory-limit", "1K"] + paths))
+            self.assertEqual(retcode, 0)
+            self.assertEqual(output, expected)
+        
+        long_lines = MockupFile("x" * 10000, "a", "y" * 5000)
+        retcode, output = call_setop("-u", "--memory-limit", "1K", long_lines.path)
+        self.assertEqual(retcode, 0)
+        self.assertEqual(output, sorted_output("x" * 10000, "a", "y" * 5000))
+        
+        retcode, output = call_setop("-m", "-u", "--memory-limit", "1K", "-", self.y.path,
+                                     input_="b\nb\nc\nb\nb\nb\n")
+        self.assertEqual(retcode, 0)
+        self.assertEqual(output, sorted_output("a", "a", "a", "b", "b", "b", "b", "b", "c"))
+        
+        # Peak RSS exceeds that of a run on a tiny input by at most the limit,
+        # whether the input is piped or a regular file read into a reused buffer.
+        lines = b"".join(b"%020d\n" % (i * 7919 % 300000) for i in range(300000))
+        regular = MockupFileRaw(lines, EOL=b"")
+        peak_rss = []
+        for path, input_ in ((self.a.path, b""), ("-", lines), (regular.path, b"")):
+            p = subprocess.run(SETOP + ["-u", "--memory-limit", "4M", "--buffer-size", "64K",
+                                        "--stats", "--stats-format", "json",
+                                        "-o", os.devnull, path],
+                               input=input_, stderr=subprocess.PIPE)
+            self.assertEqual(p.returncode, 0)
+            peak_rss.append(json.loads(p.stderr)["peak_rss_kib"])
+        self.assertLessEqual(peak_rss[1] - peak_rss[0], 4096)
+        self.assertLessEqual(peak_rss[2] - peak_rss[0], 4096)
+        
+        retcode, _ = call_setop("-p", "--memory-limit", "1M", self.a.path)
+        self.assertGreater(retcode, 0)
+        
+        retcode, _ = call_setop("-u", "--memory-limit", "lots", self.a.path)
+        self.assertGreater(retcode, 0)
+    
+    def test_presorted(self):
+        a = MockupFile("bar", "baz", "foo")
+        x = MockupFile("a", "a", "b", "b", "b", "c")
+        y = MockupFile("a", "a", "a", "b", "b", "b", "b")
+        for mode in (["-u"], ["-i"], ["-d"], ["-m", "-u"], ["-m", "-i"], ["-m", "-d"], ["-m", "-s"]):
+            paths = list(mockfile_paths(x, a, y))
+            _, expected = call_setop(*(mode + paths))
+            retcode, output = call_setop(*(mode + ["--presorted"] + paths))
+            self.assertEqual(retcode, 0)
+            self.assertEqual(output, expected)
+        
+        retcode, output = call_setop("-d", "--presorted", "-", a.path,
+                                     input_="bar\nspam\n")
+        self.assertEqual(retcode, 0)
+        self.assertEqual(output, sorted_output("spam"))
+        
+        retcode, _ = call_setop("-u", "--presorted", *mockfile_paths(a, self.a))
+        self.assertGreater(retcode, 0)
+        
+        retcode, _ = call_setop("-p", "--presorted", a.path)
+        self.assertGreater(retcode, 0)
+    
+    def test_jobs(self):
+        for mode in (["-u"], ["-i"], ["-d"], ["-m", "-u"], ["-m", "-i"], ["-m", "-d"], ["-m", "-s"]):
+            paths = list(mockfile_paths(self.x, self.a, self.y, self.b))
+            _, expected = call_setop(*(mode + paths))
+            retcode, output = call_setop(*(mode + ["--jobs", "3"] + paths))
+            self.assertEqual(retcode, 0)
+            self.assertEqual(output, expected)
+        
+        # Inputs larger than a byte range are split between the workers.
+        big = MockupFile(*("%d" % (i % 150000) for i in range(300000)))
+        small = MockupFile(*("%d" % i for i in range(0, 300000, 7)))
+        for mode in (["-u"], ["-d"], ["-m", "-i"]):
+            expected = subprocess.run(SETOP + mode + [big.path, small.path],
+                                      stdout=subprocess.PIPE).stdout
+            p = subprocess.run(SETOP + mode + ["-j", "3", big.path, small.path],
+                               stdout=subprocess.PIPE)
+            self.assertEqual(p.returncode, 0)
+            self.assertEqual(p.stdout, expected)
+        
+        retcode, output = call_setop("-i", "-j", "2")
+        self.assertEqual(retcode, 0)
+        self.assertEqual(output, "")
+        
+        x = MockupFileRaw(gzip.compress(b"a\na\nb\nb\nb\nc"), EOL=b"")
+        retcode, output = call_setop("-m", "-u", "-j", "2", x.path, "-", input_="c\nc\nd")
+        self.assertEqual(retcode, 0)
+        self.assertEqual(output, sorted_output("a", "a", "b", "b", "b", "c", "c", "d"))
+        
+        retcode, output = call_setop("-d", "-j", "3", "--order", "none", "-", self.b.path,
+                                     input_="foo\nbar\nspam\n")
+        self.assertEqual(retcode, 0)
+        self.assertEqual(sorted_output(*output.split("\n")), sorted_output("foo", "spam"))
+        
+        retcode, _ = call_setop("-u", "-j", "0", self.a.path)
+        self.assertGreater(retcode, 0)
+        
+        retcode, _ = call_setop("-p", "-j", "2", self.a.path)
+        self.assertGreater(retcode, 0)
+    
+    def test_output(self):
+        output_path = tempfile.mktemp()
+        try:
+            retcode, output = call_setop("-u", "--buffer-size", "4", "-o", output_path,
+                                         *mockfile_paths(self.a, self.c))
+            self.assertEqual(retcode, 0)
+            self.assertEqual(output, "")
+            with open(output_path) as fp:
+                self.assertEqual(fp.read(), "bar\nbaz\nfoo\nquux\n")
+        finally:
+            os.remove(output_path)
+        
+        p = subprocess.Popen(SETOP + ["-m", "-u", "--report", self.x.path],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, report = p.communicate()
+        self.assertEqual(p.returncode, 0)
+        self.assertEqual(output, b"a\na\nb\nb\nb\nc\n")
+        self.assertTrue(report.startswith(b"lines=6 bytes=12 "))
+        
+        # Write errors are reported in one line, without a traceback.
+        for output_path in ("/dev/full", os.path.join(tempfile.mktemp(), "missing")):
+            if output_path == "/dev/full" and not os.path.exists(output_path):
+                continue
+            p = subprocess.Popen(SETOP + ["-u", "-o", output_path, self.a.path],
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            output, error = p.communicate()
+            self.assertEqual(p.returncode, 1)
+            self.assertEqual(len(error.splitlines()), 1)
+        
+        # A reader closing the pipe early stops setop quietly.
+        big = MockupFile(*map(str, range(200000)))
+        p = subprocess.Popen(SETOP + ["-u", big.path],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.assertEqual(p.stdout.readline(), b"0\n")
+        p.stdout.close()
+        error = p.stderr.read()
+        p.stderr.close()
+        p.wait()
+        self.assertEqual(error, b"")
+        self.assertNotEqual(p.returncode, 0)
+    
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_hash_keys(self):
+        for mode in ("-i", "-d"):
+            for bits in ("64", "128"):
+                paths = list(mockfile_paths(self.a, self.b, self.c))
+                _, expected = call_setop(mode, *paths)
+                retcode, output = call_setop(mode, "--hash-keys", bits, *paths)
+                self.assertEqual(retcode, 0)
+                self.assertEqual(output, expected)
+        
+        retcode, output = call_setop("-d", "--hash-keys", "64", self.a.path, "-",
+                                     input_="foo\nspam\n")
+        self.assertEqual(retcode, 0)
+        self.assertEqual(output, sorted_output("bar", "baz"))
+        
+        big = MockupFile("b", "c", "a", "c", "b", "d", "e", "c", "a")
+        for bits in ("64", "128"):
+            retcode, output = call_setop("-d", "--hash-keys", bits, "--order", "first-seen",
+                                         *mockfile_paths(big, self.c))
+            self.assertEqual(retcode, 0)
+            self.assertEqual(output, "b\nc\na\nd\ne")
+            
+            retcode, output = call_setop("-i", "--hash-keys", bits, "-c", big.path, "-",
+                                         input_="e\na\nf\n")
+            self.assertEqual(retcode, 0)
+            self.assertEqual(output, "2")
+        
+        retcode, _ = call_setop("-d", "--hash-keys", "64", "-", self.a.path,
+                                input_="foo\nspam\n")
+        self.assertGreater(retcode, 0)
+        
+        retcode, _ = call_setop("-u", "--hash-keys", "64", self.a.path)
+        self.assertGreater(retcode, 0)
+        
+        retcode, _ = call_setop("-m", "-i", "--hash-keys", "64", self.a.path)
+        self.assertGreater(retcode, 0)
+    
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_approx(self):
+        for mode in ("-i", "-d"):
+            for verify in ([], ["--verify"]):
+                paths = list(mockfile_paths(self.a, self.b, self.c))
+                _, expected = call_setop(mode, *paths)
+                retcode, output = call_setop(mode, "--approx", "0.01", *(verify + paths))
+                self.assertEqual(retcode, 0)
+                self.assertEqual(output, expected)
+        
+        filter_dir = tempfile.mkdtemp()
+        try:
+            filter_path = os.path.join(filter_dir, "b.bloom")
+            retcode, expected = call_setop("-d", "--approx", "0.01", "--save-filter", filter_path,
+                                           self.a.path, self.b.path)
+            self.assertEqual(retcode, 0)
+            retcode, output = call_setop("-d", "--approx", "0.01", "--load-filter", filter_path,
+                                         self.a.path)
+            self.assertEqual(retcode, 0)
+            self.assertEqual(output, expected)
+            
+            retcode, _ = call_setop("-d", "--approx", "0.01", "--load-filter", self.b.path,
+                                    self.a.path)
+            self.assertGreater(retcode, 0)
+        finally:
+            for name in os.listdir(filter_dir):
+                os.remove(os.path.join(filter_dir, name))
+            os.rmdir(filter_dir)
+        
+        retcode, output = call_setop("-i", "--approx", "0.01", "-", self.a.path,
+                                     input_="foo\nspam\n")
+        self.assertEqual(retcode, 0)
+        self.assertEqual(output, sorted_output("foo"))
+        
+        for arguments in (["-u", "--approx", "0.01"], ["-m", "-i", "--approx", "0.01"],
+                          ["-i", "--verify"], ["-i", "--approx", "2"]):
+            retcode, _ = call_setop(*(arguments + [self.a.path, self.b.path]))
+            self.assertGreater(retcode, 0)
+    
+    def test_index(self):
+        index_dir = tempfile.mkdtemp()
+        try:
+            for mode in (["-u"], ["-i"], ["-d"], ["-p"], ["-m", "-u"], ["-m", "-i"],
+                         ["-m", "-d"], ["-m", "-s"], ["-m", "-p"]):
+                paths = list(mockfile_paths(self.x, self.a, self.y))
+                _, expected = call_setop(*(mode + paths))
+                for _ in range(2):
+                    retcode, output = call_setop(*(mode + ["--index", "--index-dir", index_dir]
+                                                   + paths))
+                    self.assertEqual(retcode, 0)
+                    self.assertEqual(output, expected)
+            self.assertEqual(len(os.listdir(index_dir)), 3)
+            
+            retcode, output = call_setop("-m", "-u", "--index", "--index-dir", index_dir,
+                                         self.x.path, "-", input_="c\nc\nd\n")
+            self.assertEqual(retcode, 0)
+            self.assertEqual(output, sorted_output("a", "a", "b", "b", "b", "c", "c", "d"))
+            
+            with open(self.x.path, "a") as fp:
+                fp.write("\nd\nd")
+            retcode, output = call_setop("-m", "-i", "--index", "--index-dir", index_dir,
+                                         *mockfile_paths(self.x, self.x))
+            self.assertEqual(retcode, 0)
+            self.assertEqual(output, sorted_output("a", "a", "b", "b", "b", "c", "d", "d"))
+            
+            # stdin redirected from a file is read directly, not indexed.
+            d = MockupFile("bar", "quuz")
+            os.utime(d.path, ns=(os.stat(self.c.path).st_atime_ns,
+                                 os.stat(self.c.path).st_mtime_ns))
+            for path, expected in ((self.c.path, "bar\nquux"), (d.path, "bar\nquuz")):
+                with open(path, "rb") as stdin:
+                    output = subprocess.run(SETOP + ["-u", "--index", "--index-dir", index_dir,
+                                                     "-"],
+                                            stdin=stdin, stdout=subprocess.PIPE).stdout
+                self.assertEqual(output.decode("ascii").rstrip("\n"), expected)
+            self.assertEqual(len(os.listdir(index_dir)), 3)
+        finally:
+            for name in os.listdir(index_dir):
+                os.remove(os.path.join(index_dir, name))
+            os.rmdir(index_dir)
+        
+        retcode, output = call_setop("-d", "--index", *mockfile_paths(self.a, self.c))
+        try:
+            self.assertEqual(retcode, 0)
+            self.assertEqual(output, sorted_output("baz", "foo"))
+            self.assertTrue(os.path.exists(self.a.path + ".setop-index"))
+            # Indexes are shared like the files they index.
+            umask = os.umask(0)
+            os.umask(umask)
+            self.assertEqual(os.stat(self.a.path + ".setop-index").st_mode & 0o777,
+                             0o666 & ~umask)
+        finally:
+            for path in mockfile_paths(self.a, self.c):
+                os.remove(path + ".setop-index")
+        
+        # Files whose index cannot be written are read directly.
+        retcode, output = call_setop("-d", "--index", "--index-dir", self.b.path,
+                                     *mockfile_paths(self.a, self.c))
+        self.assertEqual(retcode, 0)
+        self.assertEqual(output, sorted_output("baz", "foo"))
+        
+        retcode, _ = call_setop("-u", "--index", "--presorted", self.a.path)
+        self.assertGreater(retcode, 0)
+    
+    def test_count(self):
+        for mode in (["-u"], ["-i"], ["-d"], ["-p"], ["-m", "-u"], ["-m", "-i"],
+                     ["-m", "-d"], ["-m", "-s"], ["-m", "-p"], ["-m", "-i", "--presorted"],
+                     ["-m", "-u", "--memory-limit", "1K"]):
+            paths = list(mockfile_paths(self.x, self.y))
+            _, expected = call_setop(*(mode + paths))
+            retcode, output = call_setop(*(mode + ["--count"] + paths))
+            self.assertEqual(retcode, 0)
+            self.assertEqual(output, str(len(expected.splitlines())))
+        
+        retcode, output = call_setop("-d", "-c")
+        self.assertEqual(retcode, 0)
+        self.assertEqual(output, "0")
+    
+    def test_estimate(self):
+        retcode, output = call_setop("-u", "--estimate", *mockfile_paths(self.a, self.b, self.c))
+        self.assertEqual(retcode, 0)
+        self.assertEqual(output, "cardinality\t4\njaccard\t0.250000")
+        
+        retcode, output = call_setop("-i", "-e", *mockfile_paths(self.a, self.b))
+        self.assertEqual(retcode, 0)
+        self.assertEqual(output, "cardinality\t2\njaccard\t0.666667")
+        
+        retcode, output = call_setop("-d", "-e", "-", *mockfile_paths(self.a, self.b),
+                                     input_="spam\nfoo\nham\n")
+        self.assertEqual(retcode, 0)
+        self.assertEqual(output, "cardinality\t2\njaccard\t0.000000")
+        
+        retcode, _ = call_setop("-m", "-u", "-e", self.a.path)
+        self.assertGreater(retcode, 0)
+        
+        # Large inputs are estimated from hashes that are the same in every run.
+        lines = "".join("%d\n" % i for i in range(20000))
+        outputs = {call_setop("-u", "-e", "-", input_=lines)[1] for _ in range(3)}
+        self.assertEqual(len(outputs), 1)
+        
+        retcode, _ = call_setop("-u", "-e", "-c", self.a.path)
+        self.assertGreater(retcode, 0)
+    
+    def test_order(self):
+        a = MockupFile("c", "b", "a", "b", "d")
+        b = MockupFile("a", "e", "b")
+        
+        for mode in (["-u"], ["-i"], ["-d"], ["-p"], ["-m", "-u"], ["-m", "-i"],
+                     ["-m", "-d"], ["-m", "-s"], ["-m", "-p"]):
+            paths = list(mockfile_paths(a, b))
+            _, expected = call_setop(*(mode + paths))
+            retcode, output = call_setop(*(mode + ["--order", "none"] + paths))
+            self.assertEqual(retcode, 0)
+            self.assertEqual(sorted_output(*output.split("\n")), expected)
+        
+        retcode, output = call_setop("-u", "--order", "first-seen", *mockfile_paths(a, b))
+        self.assertEqual(retcode, 0)
+        self.assertEqual(output, "c\nb\na\nd\ne")
+        
+        retcode, output = call_setop("-d", "--order", "first-seen", *mockfile_paths(a, b))
+        self.assertEqual(retcode, 0)
+        self.assertEqual(output, "c\nd")
+        
+        retcode, output = call_setop("-m", "-i", "--order", "first-seen", *mockfile_paths(a, b))
+        self.assertEqual(retcode, 0)
+        self.assertEqual(output, "b\na")
+        
+        retcode, output = call_setop("-p", "--order", "first-seen", "-", b.path,
+                                     input_="y\nx\n")
+        self.assertEqual(retcode, 0)
+        self.assertEqual(output, "y\ta\ny\te\ny\tb\nx\ta\nx\te\nx\tb")
+        
+        retcode, _ = call_setop("-u", "--order", "first-seen", "--presorted", a.path)
+        self.assertGreater(retcode, 0)
+    
+    def test_probe_order(self):
+        big = MockupFile("b", "c", "a", "c", "b", "d", "e", "c", "a")
+        small = MockupFile("c", "a", "c")
+        
+        retcode, output = call_setop("-m", "-i", "-", *mockfile_paths(big, small),
+                                     input_="c\nc\nc\na\n")
+        self.assertEqual(retcode, 0)
+        self.assertEqual(output, sorted_output("a", "c", "c"))
+        
+        retcode, output = call_setop("-i", "--order", "first-seen", *mockfile_paths(big, small))
+        self.assertEqual(retcode, 0)
+        self.assertEqual(output, "c\na")
+        
+        retcode, output = call_setop("-m", "-d", big.path, "-", small.path,
+                                     input_="e\nb\n")
+        self.assertEqual(retcode, 0)
+        self.assertEqual(output, sorted_output("a", "b", "c", "d"))
+        
+        retcode, output = call_setop("-i", *mockfile_paths(self.a, self.c, big))
+        self.assertEqual(retcode, 0)
+        self.assertEqual(output, "")
+    
+    def test_counts(self):
+        retcode, output = call_setop("-m", "-s", "--counts", *mockfile_paths(self.x, self.y))
+        self.assertEqual(retcode, 0)
+        self.assertEqual(output, "5\ta\n7\tb\n1\tc")
+        
+        for mode in (["-u"], ["-i"], ["-d"], ["-s"], ["-i", "--presorted"],
+                     ["-u", "--memory-limit", "1K"], ["-s", "--jobs", "2"]):
+            retcode, output = call_setop(*(["-m", "--counts"] + mode
+                                           + list(mockfile_paths(self.y, self.x))))
+            self.assertEqual(retcode, 0)
+            _, expected = call_setop(*(["-m"] + mode + list(mockfile_paths(self.y, self.x))))
+            self.assertEqual("\n".join(line.split("\t")[1]
+                                       for line in output.split("\n")
+                                       for _ in range(int(line.split("\t")[0]))),
+                             expected)
+        
+        retcode, output = call_setop("-m", "-p", "--counts", "-D", ":", "-", self.x.path,
+                                     input_="p\nq\nq\n")
+        self.assertEqual(retcode, 0)
+        self.assertEqual(output, "2\tp:a\n3\tp:b\n1\tp:c\n4\tq:a\n6\tq:b\n2\tq:c")
+        
+        retcode, _ = call_setop("-u", "--counts", self.x.path)
+        self.assertGreater(retcode, 0)
+    
+    def test_key(self):
+        records = MockupFile("1\tfoo\tx", "2\tbar\ty", "3\tbaz", "4", "2\tbar\tz")
+        keys = MockupFile("2", "5")
+        
+        retcode, output = call_setop("-i", "-k", "1", *mockfile_paths(records, keys))
+        self.assertEqual(retcode, 0)
+        self.assertEqual(output, sorted_output("2\tbar\ty", "2\tbar\tz"))
+        
+        retcode, output = call_setop("-d", "--key", "1", *mockfile_paths(records, keys))
+        self.assertEqual(retcode, 0)
+        self.assertEqual(output, sorted_output("1\tfoo\tx", "3\tbaz", "4"))
+        
+        retcode, output = call_setop("-u", "-k", "1", *mockfile_paths(records, keys))
+        self.assertEqual(retcode, 0)
+        self.assertEqual(output, sorted_output("1\tfoo\tx", "2\tbar\ty", "2\tbar\tz",
+                                               "3\tbaz", "4", "5"))
+        
+        second_keys = MockupFile("x,2", "y,5", "z")
+        retcode, output = call_setop("-i", "-k", "2", "-t", ",", "-", second_keys.path,
+                                     input_="a,2,b\nc,5\nd,6\ne\n")
+        self.assertEqual(retcode, 0)
+        self.assertEqual(output, sorted_output("a,2,b", "c,5", "e"))
+        
+        retcode, output = call_setop("-m", "-d", "-k", "2", "-D", ",", "-", second_keys.path,
+                                     input_="d,6\ne\nd,6\nf,5\n")
+        self.assertEqual(retcode, 0)
+        self.assertEqual(output, sorted_output("d,6", "d,6"))
+        
+        retcode, _ = call_setop("-p", "-k", "1", *mockfile_paths(records, keys))
+        self.assertGreater(retcode, 0)
+        
+        retcode, _ = call_setop("-i", "-k", "1", "-t", "::", *mockfile_paths(records, keys))
+        self.assertGreater(retcode, 0)
+    
+    def test_compression(self):
+        compressed = {"gzip": gzip.compress, "bz2": bz2.compress, "xz": lzma.compress}
+        for compress in compressed.values():
+            x = MockupFileRaw(compress(b"a\na\nb\nb\nb\nc"), EOL=b"")
+            for mode in (["-u"], ["-i"], ["-m", "-s"], ["-m", "-i", "--presorted"]):
+                _, expected = call_setop(*(mode + list(mockfile_paths(self.x, self.y))))
+                retcode, output = call_setop(*(mode + [x.path, self.y.path]))
+                self.assertEqual(retcode, 0)
+                self.assertEqual(output, expected)
+            
+            retcode, output = call_setop_raw("-d", "-", self.b.path, input_=compress(b"bar\nspam\n"))
+            self.assertEqual(retcode, 0)
+            self.assertEqual(output, b"spam\n")
+        
+        for compression, compress in compressed.items():
+            retcode, output = call_setop_raw("-u", "--compress", compression,
+                                             *mockfile_paths(self.a, self.c))
+            self.assertEqual(retcode, 0)
+            self.assertNotEqual(output, b"bar\nbaz\nfoo\nquux\n")
+            retcode, output = call_setop_raw("-u", "-", input_=output)
+            self.assertEqual(retcode, 0)
+            self.assertEqual(output, b"bar\nbaz\nfoo\nquux\n")
+        
+        for data in (b"", b"a\n"):
+            retcode, output = call_setop_raw("-u", "-", input_=bz2.compress(data, 1))
+            self.assertEqual(retcode, 0)
+            self.assertEqual(output, data)
+        
+        text = MockupFile("BZh9 is a line of text", "BZh91AY")
+        retcode, output = call_setop("-u", text.path)
+        self.assertEqual(retcode, 0)
+        self.assertEqual(output, sorted_output("BZh9 is a line of text", "BZh91AY"))
+        
+        truncated = MockupFileRaw(gzip.compress(b"a\nb\n" * 1000)[:-20], EOL=b"")
+        retcode, _ = call_setop("-u", truncated.path)
+        self.assertGreater(retcode, 0)
+    
+    def test_stats(self):
+        p = subprocess.Popen(SETOP + ["-m", "-u", "--stats", "--stats-format", "json",
+                                      self.x.path, "-"],
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, stats = p.communicate(b"c\nd\n")
+        self.assertEqual(p.returncode, 0)
+        self.assertEqual(output, b"a\na\nb\nb\nb\nc\nd\n")
+        stats = json.loads(stats)
+        self.assertEqual(set(stats["phases"]), {"load", "sort", "write"})
+        self.assertEqual([(file["lines"], file["bytes"], file["distinct"], file["duplicates"])
+                          for file in stats["inputs"]],
+                         [(6, 11, 3, 3), (2, 4, 2, 0)])
+        self.assertEqual(stats["output"], {"lines": 7, "bytes": 14})
+        
+        p = subprocess.Popen(SETOP + ["-i", "--presorted", "--stats", self.b.path, self.b.path],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, stats = p.communicate()
+        self.assertEqual(p.returncode, 0)
+        self.assertIn(b"lines=2 bytes=7 distinct=- duplicates=-", stats)
+        
+        # Inputs read more than once are counted once, with their number of passes.
+        if numpy is not None:
+            for options in (["-d", "--hash-keys", "64"], ["-i", "--approx", "0.01", "--verify"]):
+                p = subprocess.Popen(SETOP + options + ["--stats", "--stats-format", "json",
+                                                        self.b.path, self.c.path],
+                                     stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                output, stats = p.communicate()
+                self.assertEqual(p.returncode, 0)
+                self.assertEqual([(file["lines"], file["bytes"])
+                                  for file in json.loads(stats)["inputs"]],
+                                 [(2, 7), (2, 8)])
+        
+        # Inputs read by workers or through an index have no read statistics.
+        index_dir = tempfile.mkdtemp()
+        try:
+            for options, lines in ((["-j", "2"], None), (["--index", "--index-dir", index_dir], 2),
+                                   (["--index", "--index-dir", index_dir], None)):
+                p = subprocess.Popen(SETOP + ["-u", "--stats", "--stats-format", "json",
+                                              self.b.path] + options,
+                                     stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                output, stats = p.communicate()
+                self.assertEqual(p.returncode, 0)
+                self.assertEqual(output, b"bar\nbaz\n")
+                self.assertEqual(json.loads(stats)["inputs"][0]["lines"], lines)
+        finally:
+            for name in os.listdir(index_dir):
+                os.remove(os.path.join(index_dir, name))
+            os.rmdir(index_dir)
+        
+        profile_path = tempfile.mktemp()
+        try:
+            retcode, output = call_setop("-u", "--profile", profile_path,
+                                         *mockfile_paths(self.a, self.b))
+            self.assertEqual(retcode, 0)
+            self.assertEqual(output, sorted_output("foo", "bar", "baz"))
+            self.assertTrue(pstats.Stats(profile_path).total_calls > 0)
+        finally:
+            os.remove(profile_path)
+    
+    def test_expression(self):
+        paths = list(mockfile_paths(self.a, self.b, self.c, self.x))
+        for expression, expected in (("($1 | $3) - ($2 & $3)", ["baz", "foo", "quux"]),
+                                     ("$1 - $2 | $3 & $1", ["bar", "foo"]),
+                                     ("$1 - $2 & $3", []),
+                                     ("$1 ∩ ($2 ∪ $3)", ["bar", "baz"]),
+                                     ("$4 | $4 - $4", ["a", "b", "c"])):
+            retcode, output = call_setop("--expr", expression, *paths)
+            self.assertEqual(retcode, 0)
+            self.assertEqual(output, sorted_output(*expected))
+        
+        retcode, output = call_setop("-m", "-E", "$1 + $1 - $2", *mockfile_paths(self.x, self.y))
+        self.assertEqual(retcode, 0)
+        self.assertEqual(output, sorted_output("a", "b", "b", "c", "c"))
+        
+        directory = tempfile.mkdtemp()
+        try:
+            for name, lines in (("users.txt", "ann\nbob\ncid\n"), ("banned.txt", "bob\n")):
+                with open(os.path.join(directory, name), "w") as fp:
+                    fp.write(lines)
+            retcode, output = call_setop("-E", "users - banned", "--order", "first-seen", "-",
+                                         os.path.join(directory, "users.txt"),
+                                         os.path.join(directory, "banned.txt"),
+                                         input_="zed\n")
+            self.assertEqual(retcode, 0)
+            self.assertEqual(output, "ann\ncid")
+            
+            # Names with operators or spaces can be used as they are, or quoted.
+            for name, lines in (("all-users.txt", "ann\nbob\ncid\n"), ("new users.txt", "dan\n")):
+                with open(os.path.join(directory, name), "w") as fp:
+                    fp.write(lines)
+            paths = [os.path.join(directory, name)
+                     for name in ("all-users.txt", "banned.txt", "new users.txt")]
+            for expression, expected in (("all-users - banned", ["ann", "cid"]),
+                                         ("all-users-banned", ["ann", "cid"]),
+                                         ("(all-users.txt)&banned", ["bob"]),
+                                         ("banned | 'new users'", ["bob", "dan"]),
+                                         ("new users|banned", ["bob", "dan"]),
+                                         ('"all-users" - "banned.txt"', ["ann", "cid"])):
+                retcode, output = call_setop("-E", expression, *paths)
+                self.assertEqual(retcode, 0)
+                self.assertEqual(output, sorted_output(*expected))
+            for expression in ("all - banned", "new - banned", "'banned"):
+                retcode, _ = call_setop("-E", expression, *paths)
+                self.assertGreater(retcode, 0)
+        finally:
+            for name in os.listdir(directory):
+                os.remove(os.path.join(directory, name))
+            os.rmdir(directory)
+        
+        for expression in ("$1 + $2", "$1 & ($2", "$1 $2", "$3", "nonexistent", "| $1"):
+            retcode, _ = call_setop("-E", expression, *mockfile_paths(self.a, self.b))
+            self.assertGreater(retcode, 0)
+        
+        retcode, _ = call_setop("-E", "$1", "-u", self.a.path)
+        self.assertGreater(retcode, 0)
+    
+    def test_library(self):
+        self.assertEqual(list(setop.union(self.a.path, [b"quux\n", b"bar"])),
+                         [b"bar", b"baz", b"foo", b"quux"])
+        self.assertEqual(list(setop.intersection(["foo", "bar", "spam"], self.a.path,
+                                                 order="first-seen", encoding="ascii")),
+                         ["foo", "bar"])
+        with open(self.a.path, "rb") as fp:
+            self.assertEqual(list(setop.difference(fp, [b"foo"])), [b"bar", b"baz"])
+        self.assertEqual(list(setop.multiset_sum(self.x.path, ["c", "d"], counts=True)),
+                         [(b"a", 2), (b"b", 3), (b"c", 2), (b"d", 1)])
+        self.assertEqual(list(setop.product(["x", "y"], ["1"], delimiter=":", encoding="ascii")),
+                         ["x:1", "y:1"])
+        self.assertEqual(list(setop.union(self.x.path, self.y.path, multiset=True,
+                                          memory_limit=1024)),
+                         list(setop.union(self.x.path, self.y.path, multiset=True)))
+        
+        self.assertEqual(list(setop.set_expression("($1 | $2) - $3", ["a", "b"], ["c"], ["b"])),
+                         [b"a", b"c"])
+        
+        operation = setop.union(self.a.path, presorted=True, jobs=2)
+        self.assertRaises(ValueError, next, operation)
+    
+    def test_simple_args(self):
+        application = setop.SetOp()
+        for args in (["-u"], ["-m", "--intersection", "-c"], ["-s", "-m", "-s"], ["--product"]):
+            simple = application.parse_simple_args(args + [self.a.path, self.b.path])
+            full = application.parser.parse_args(args + [self.a.path, self.b.path])
+            self.assertEqual([file.name for file in simple.files],
+                             [file.name for file in full.files])
+            for file in simple.files + full.files:
+                file.close()
+            del simple.files, full.files
+            self.assertEqual(vars(simple), vars(full))
+        
+        for args in (["-u", "-n", "unix"], ["-u", "-i"], ["-mu"], ["-m"], ["-u", "nonexistent"]):
+            self.assertIsNone(application.parse_simple_args(args + [self.a.path]))
     
     def test_failure(self):
         retcode, _ = call_setop("-p", "-u")